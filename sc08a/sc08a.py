@@ -1,4 +1,12 @@
-from typing import List, Optional
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Event, Lock, RLock, Thread
+from pathlib import Path
+import itertools
+import runpy
+import json
+import math
+import numbers
 import sys
 import time
 import argparse
@@ -9,6 +17,19 @@ from werkzeug import serving
 import serial
 
 
+class ChannelState(NamedTuple):
+    """Model of a servo channel of :class:`SC08A`
+
+    The servo is taken to move from :code:`start` at :code:`time` towards
+    :code:`target` at a rate given by :code:`speed`.
+
+    """
+    target: int
+    speed: int
+    start: float
+    time: float
+
+
 class SC08A:
     """A class to manage SC08A PWM 8 Channel servo controller
 
@@ -21,6 +42,9 @@ class SC08A:
     In Raspberry Pi, the serial communication while boot has to be disabled and
     UART has to be enabled. After that the port will appear as :code:`/dev/ttyS0`
 
+    Any URL supported by :func:`serial.serial_for_url` also works, e.g.
+    :code:`loop://` to try it out without a controller.
+
     The user should have appropriate write permission on the port.
 
     Commands `on_motor`, `off_motor` and `get_pos` require a single byte
@@ -34,10 +58,22 @@ class SC08A:
        the position
     3. The fourth byte for :meth:`set_pos_speed` determines the speed
 
+    The controller keeps a model of each channel (:class:`ChannelState`)
+    from the commands sent and the positions read, so that relative moves
+    (:meth:`move_relative`) don't have to read the position first, and the
+    current position can be estimated without a read (:meth:`estimate_pos`).
+    The model can be corrected periodically from the hardware with
+    :meth:`start_resync`.
+
+    Each command is written (and read) under :code:`lock` so that the bytes of
+    the commands from different threads don't interleave.
+
     Args:
         portname: The serial port on which the controller is accessible
         baudrate: The baudrate to connect with the serial port
         debug: Whether to print additional debug information
+        speed_scale: Position units per second moved per unit of speed, for
+                     the model. A speed of 0 is taken as an instant move.
 
 
     TODO:
@@ -45,10 +81,17 @@ class SC08A:
 
     """
 
-    def __init__(self, portname: str, baudrate: Optional[int], debug: bool = False):
-        self.baudrate = baudrate or 9600
+    def __init__(self, portname: str, baudrate: Optional[int], debug: bool = False,
+                 speed_scale: float = 20.):
+        self.baudrate = int(baudrate or 9600)
         self.debug = debug
-        self.port = serial.Serial(portname, self.baudrate, timeout=0.1, write_timeout=0.1)
+        self.speed_scale = speed_scale
+        self.port = serial.serial_for_url(portname, self.baudrate, timeout=0.1,
+                                          write_timeout=0.1)
+        self.lock = RLock()
+        self.channels: Dict[int, ChannelState] = {}
+        self._resync_stop = Event()
+        self._resync_thread: Optional[Thread] = None
 
     def init_all_motors(self):
         """Initialize all motors.
@@ -56,7 +99,8 @@ class SC08A:
         One has to turn the motor off individually though.
 
         """
-        self.port.write(bytes([0b11000000, 1]))
+        with self.lock:
+            self.port.write(bytes([0b11000000, 1]))
 
     def on_motor(self, channels: int):
         """Turn on the motor for the given channel.
@@ -68,7 +112,8 @@ class SC08A:
 
         """
         first_byte = 0b11000000 | channels
-        self.port.write(bytes([first_byte, 1]))
+        with self.lock:
+            self.port.write(bytes([first_byte, 1]))
 
     def off_motor(self, channels: int):
         """Turn off the motor for the given channel.
@@ -80,7 +125,38 @@ class SC08A:
 
         """
         first_byte = 0b11000000 | channels
-        self.port.write(bytes([first_byte, 0]))
+        with self.lock:
+            self.port.write(bytes([first_byte, 0]))
+
+    max_pos = 8191
+    # A measured position within this of the commanded one has reached it
+    settle_tolerance = 16
+
+    @classmethod
+    def check_command(cls, channel: int, pos: int, speed: int):
+        """Raise :class:`ValueError` if the command can't be packed
+
+        The channel is 0 (all channels) to 8, the position a 13 bit int and the
+        speed a byte.
+
+        """
+        for name, value, high in (("channel", channel, 8), ("position", pos, cls.max_pos),
+                                  ("speed", speed, 255)):
+            if not isinstance(value, numbers.Integral) or isinstance(value, bool) or not 0 <= value <= high:
+                raise ValueError(f"Invalid {name} {value!r}, must be an int from 0 to {high}")
+
+    @classmethod
+    def pack_pos_speed(cls, channel: int, pos: int, speed: int) -> bytes:
+        """Pack the 4 bytes of :meth:`set_pos_speed`
+
+        The 13 bit position is split into its high 7 bits and low 6 bits.
+
+        Raises:
+            ValueError: If the command is invalid, see :meth:`check_command`
+
+        """
+        cls.check_command(channel, pos, speed)
+        return bytes((0b11100000 | channel, (pos >> 6) & 0x7F, pos & 0x3F, speed))
 
     def set_pos_speed(self, channels: int, pos: int, speed: int):
         """Set position and speed for the given channels
@@ -94,18 +170,90 @@ class SC08A:
 
 
         """
-        byte_1 = 0b11100000 | channels
-        str_pos = bin(0b10000000000000 | pos)[3:]
-        byte_2 = '0' + str_pos[:7]
-        if self.debug:
-            print("byte_2", byte_2, int(byte_2, 2))
-        byte_2 = int(byte_2, 2)  # type: ignore
-        byte_3 = '00' + str_pos[7:]
+        packet = self.pack_pos_speed(channels, pos, speed)
         if self.debug:
-            print("byte_3", byte_3, int(byte_3, 2))
-        byte_3 = int(byte_3, 2)  # type: ignore
-        byte_4 = speed
-        self.port.write(bytes([byte_1, byte_2, byte_3, byte_4]))  # type: ignore
+            print("byte_2", bin(packet[1]), packet[1])
+            print("byte_3", bin(packet[2]), packet[2])
+        with self.lock:
+            self.port.write(packet)
+            self._commanded(channels, pos, speed)
+
+    def set_pos_speeds(self, commands: Iterable[Tuple[int, int, int]]):
+        """Set position and speed of many channels with a single write
+
+        The packets of all the commands are packed into one buffer so that the
+        motors start as close together as the baudrate allows. When all the 8
+        channels get the same position and speed, a single packet for channel
+        0 (all channels) is sent instead.
+
+        The controller addresses channels by number, so only the all channels
+        form can be shared by several channels.
+
+        Args:
+            commands: Tuples of channel, position and speed
+
+        """
+        commands = list(commands)
+        if not commands:
+            return
+        targets = {(pos, speed) for _, pos, speed in commands}
+        if len(targets) == 1 and {channel for channel, _, _ in commands} == set(range(1, 9)):
+            pos, speed = targets.pop()
+            buf = self.pack_pos_speed(0, pos, speed)
+        else:
+            buf = b"".join(self.pack_pos_speed(*command) for command in commands)
+        with self.lock:
+            self.port.write(buf)
+            for command in commands:
+                self._commanded(*command)
+
+    def _commanded(self, channel, pos, speed):
+        now = time.time()
+        for ch in (range(1, 9) if channel == 0 else (channel,)):
+            start = self.estimate_pos(ch, now)
+            if start is None or not speed:
+                # A speed of 0 moves at once
+                start = pos
+            self.channels[ch] = ChannelState(pos, speed, start, now)
+
+    def estimate_pos(self, channel: int, now: Optional[float] = None) -> Optional[float]:
+        """Estimate the current position of a channel from the model without a read
+
+        Returns :code:`None` if the channel hasn't been commanded or read yet.
+
+        """
+        state = self.channels.get(channel)
+        if state is None:
+            return None
+        if not state.speed:
+            # Settled at a measured or instantly commanded position
+            return float(state.start)
+        elapsed = (now or time.time()) - state.time
+        distance = state.target - state.start
+        step = state.speed * self.speed_scale * elapsed
+        if step >= abs(distance):
+            return float(state.target)
+        return state.start + step * (1 if distance > 0 else -1)
+
+    def target(self, channel: int) -> int:
+        """The last commanded position of a channel. Read from the controller if unknown."""
+        state = self.channels.get(channel)
+        if state is None:
+            return self.get_pos(channel)
+        return state.target
+
+    def move_relative(self, channel: int, delta: int, speed: int) -> int:
+        """Move a channel by :code:`delta` from its last commanded position
+
+        The position is computed from the model, so only the first move of a
+        channel reads from the controller. It's clamped to the range of
+        positions. Returns the new target position.
+
+        """
+        with self.lock:
+            pos = min(max(self.target(channel) + delta, 0), self.max_pos)
+            self.set_pos_speed(channel, pos, speed)
+        return pos
 
     def get_pos(self, channel: int):
         """Get position of a given channel
@@ -116,9 +264,102 @@ class SC08A:
             channel: The channel
 
         """
-        self.port.write(bytes([0b10100000 | channel]))
-        high, low = self.port.read(2)
-        return int(bin(0b10000000 | high)[3:] + bin(0b1000000 | low)[3:], 2)
+        with self.lock:
+            self.port.write(bytes([0b10100000 | channel]))
+            high, low = self.port.read(2)
+            pos = self.unpack_pos(high, low)
+            self._measured(channel, pos)
+        return pos
+
+    @staticmethod
+    def unpack_pos(high: int, low: int) -> int:
+        """Position from the 7 high and 6 low bits replied to a position query"""
+        return ((high & 0x7F) << 6) | (low & 0x3F)
+
+    def get_positions(self, channels: Iterable[int] = range(1, 9),
+                      timeout: Optional[float] = None) -> Dict[int, Optional[int]]:
+        """Get the positions of many channels with one write and one read
+
+        The query bytes of all the channels are written at once and the two
+        bytes replied per channel are read together, so that reading all the
+        channels takes one round trip instead of one per channel.
+
+        Args:
+            channels: The channels
+            timeout: Time to wait for all the replies. Defaults to twice the
+                     transfer time at the baudrate plus the port timeout.
+
+        Returns:
+            A :class:`dict` of channel to position. The positions of the
+            channels whose reply didn't arrive in time are :code:`None`.
+
+        """
+        channels = list(channels)
+        if not channels:
+            return {}
+        size = 2 * len(channels)
+        if timeout is None:
+            # 10 bits per byte on the wire, the queries and the replies
+            timeout = 2 * 10 * (len(channels) + size) / self.baudrate + self.port.timeout
+        buf = b""
+        with self.lock:
+            self.port.write(bytes(0b10100000 | channel for channel in channels))
+            deadline = time.time() + timeout
+            while len(buf) < size and time.time() < deadline:
+                buf += self.port.read(size - len(buf))
+            if len(buf) < size:
+                # Drop late replies so that they aren't read by the next query
+                self.port.reset_input_buffer()
+            positions: Dict[int, Optional[int]] = {}
+            for i, channel in enumerate(channels):
+                if 2 * i + 1 < len(buf):
+                    positions[channel] = self.unpack_pos(buf[2 * i], buf[2 * i + 1])
+                    self._measured(channel, positions[channel])
+                else:
+                    positions[channel] = None
+        return positions
+
+    def _measured(self, channel, pos):
+        now = time.time()
+        state = self.channels.get(channel)
+        if state is None:
+            # Nothing commanded yet, so the relative moves go from here
+            self.channels[channel] = ChannelState(pos, 0, pos, now)
+        elif abs(pos - state.target) <= self.settle_tolerance:
+            # The move has settled at the commanded position
+            self.channels[channel] = state._replace(speed=0, start=pos, time=now)
+        else:
+            # Still moving, maybe slower than the model. The commanded target
+            # is kept, the model only continues from the measured position.
+            self.channels[channel] = state._replace(start=pos, time=now)
+
+    def start_resync(self, channels: Iterable[int], interval: float = 1.):
+        """Periodically correct the model of :code:`channels` from the controller
+
+        The positions are read in a background thread every :code:`interval`
+        seconds.
+
+        """
+        self.stop_resync()
+        channels = list(channels)
+        self._resync_stop.clear()
+
+        def _resync():
+            while not self._resync_stop.wait(interval):
+                for channel in channels:
+                    try:
+                        self.get_pos(channel)
+                    except (ValueError, serial.SerialException) as e:
+                        print(f"Could not read position of channel {channel}: {e}")
+
+        self._resync_thread = Thread(target=_resync, daemon=True)
+        self._resync_thread.start()
+
+    def stop_resync(self):
+        if self._resync_thread is not None:
+            self._resync_stop.set()
+            self._resync_thread.join()
+            self._resync_thread = None
 
     def shutdown(self):
         """Stop the servo controller
@@ -129,12 +370,361 @@ class SC08A:
         """
         for i in range(1, 9):
             self.off_motor(i)
+        self.close()
+
+    def close(self):
+        """Stop the resync thread and close the serial port, leaving the motors as they are"""
+        self.stop_resync()
         self.port.close()
 
 
+class SerialWriter:
+    """Write servo commands from a thread, keeping only the newest command per channel
+
+    :meth:`submit` returns at once with a command id. Commands still pending
+    when a newer one for the same channel arrives are dropped (coalesced), so
+    under a burst of requests the motors only chase the newest target. All
+    the pending commands are written with one :meth:`SC08A.set_pos_speeds`.
+
+    A command which can't be packed or written is recorded as failed with its
+    error instead of written, and the thread goes on with the next commands.
+
+    Args:
+        controller: The :class:`SC08A`
+        lock: Lock for the serial port, shared with the other users of the
+              controller so that their bytes don't interleave
+
+    """
+    def __init__(self, controller: SC08A, lock: Optional[Lock] = None):
+        self.controller = controller
+        self.lock = lock or Lock()
+        self.coalesced = 0
+        self._pending: dict = {}
+        self._written: dict = {}
+        self._failed: dict = {}
+        self._ids = itertools.count(1)
+        self._running = True
+        self._condition = Condition()
+        self._thread = Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, channel: int, pos: int, speed: int) -> int:
+        """Queue a :meth:`SC08A.set_pos_speed` command and return its id
+
+        Raises:
+            ValueError: If the command is invalid, see :meth:`SC08A.check_command`
+            RuntimeError: If the writer has been stopped
+
+        """
+        SC08A.check_command(channel, pos, speed)
+        with self._condition:
+            if not self._running:
+                raise RuntimeError("The writer is stopped")
+            cmd_id = next(self._ids)
+            if channel == 0:
+                # All channels, which supersedes everything pending
+                self.coalesced += len(self._pending)
+                self._pending.clear()
+            elif self._pending.pop(channel, None) is not None:
+                self.coalesced += 1
+            # Reinserted at the end to keep the order relative to channel 0
+            self._pending[channel] = (cmd_id, pos, speed)
+            self._condition.notify()
+        return cmd_id
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or not self._running)
+                if not self._pending:
+                    break
+                pending, self._pending = self._pending, {}
+            errors = {}
+            for channel, (_, pos, speed) in pending.items():
+                try:
+                    SC08A.check_command(channel, pos, speed)
+                except Exception as e:
+                    errors[channel] = str(e)
+            commands = [(channel, pos, speed) for channel, (_, pos, speed) in pending.items()
+                        if channel not in errors]
+            try:
+                with self.lock:
+                    self.controller.set_pos_speeds(commands)
+            except Exception as e:
+                print(f"Could not write commands {commands}: {e}")
+                errors.update((channel, str(e)) for channel, *_ in commands)
+            with self._condition:
+                for channel, (cmd_id, _, _) in pending.items():
+                    if channel in errors:
+                        self._failed[channel] = {"id": cmd_id, "error": errors[channel]}
+                    else:
+                        self._written[channel] = cmd_id
+
+    def status(self):
+        """Ids of the pending, the last written and the last failed commands per channel
+
+        A command is done once the written id of its channel is at least its
+        own id, either because it was written or because a newer one was. The
+        failed commands have their error.
+
+        """
+        with self._condition:
+            return {"pending": {ch: cmd[0] for ch, cmd in self._pending.items()},
+                    "written": dict(self._written),
+                    "failed": dict(self._failed),
+                    "coalesced": self.coalesced}
+
+    def stop(self):
+        """Write the pending commands and stop the thread"""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+
+class Trajectory:
+    """Timed waypoints of the positions of servo channels
+
+    The position of each channel is interpolated between its waypoints,
+    linearly or with a Catmull-Rom spline through them, and held at the first
+    and the last waypoint before and after them.
+
+    Args:
+        waypoints: A :class:`dict` of channel to a list of :code:`(time, position)`
+                   with the time in seconds from the start of the trajectory
+        spline: Interpolate with a spline instead of linearly
+        speed: Speed of all the commands. If not given, the speed of each
+               command is the one which reaches the position by the next tick
+               (see :attr:`SC08A.speed_scale`).
+
+    Raises:
+        ValueError: If a channel, time, position or the speed is invalid
+
+    """
+    def __init__(self, waypoints: Dict[int, List[Tuple[float, float]]], spline: bool = False,
+                 speed: Optional[int] = None):
+        if not waypoints:
+            raise ValueError("No waypoints given")
+        if speed is not None:
+            SC08A.check_command(1, 0, speed)
+        self.waypoints = {}
+        for channel, points in waypoints.items():
+            points = sorted((float(t), float(pos)) for t, pos in points)
+            if not points:
+                raise ValueError(f"No waypoints for channel {channel}")
+            if not isinstance(channel, int) or not 1 <= channel <= 8:
+                raise ValueError(f"Invalid channel {channel!r}")
+            for t, pos in points:
+                if not 0 <= t < math.inf:
+                    raise ValueError(f"Invalid time {t} for channel {channel}")
+                if not 0 <= pos <= SC08A.max_pos:
+                    raise ValueError(f"Invalid position {pos} for channel {channel}, "
+                                     f"must be from 0 to {SC08A.max_pos}")
+            self.waypoints[channel] = points
+        self.spline = spline
+        self.speed = speed
+        self.duration = max(points[-1][0] for points in self.waypoints.values())
+
+    @classmethod
+    def from_json(cls, data: str, channel_names: Optional[Dict[str, int]] = None):
+        """Create from JSON like :code:`{"waypoints": {"1": [[0, 1000], [2, 4000]]}, "spline": true}`
+
+        The channels are numbers, or names in :code:`channel_names`.
+
+        """
+        try:
+            spec = json.loads(data)
+            waypoints = {(channel_names or {}).get(key) or int(key): points
+                         for key, points in spec["waypoints"].items()}
+            return cls(waypoints, bool(spec.get("spline", False)), spec.get("speed"))
+        except (KeyError, TypeError, AttributeError, json.JSONDecodeError) as e:
+            raise ValueError(f"Invalid trajectory: {e!r}")
+
+    def _position(self, points, t):
+        if t <= points[0][0]:
+            return points[0][1]
+        if t >= points[-1][0]:
+            return points[-1][1]
+        i = next(i for i in range(1, len(points)) if points[i][0] >= t)
+        (t0, p0), (t1, p1) = points[i - 1], points[i]
+        u = (t - t0) / (t1 - t0)
+        if not self.spline:
+            return p0 + u * (p1 - p0)
+        # Tangents from the neighbouring waypoints, scaled to this segment
+        prev_t, prev_p = points[i - 2] if i >= 2 else (t0, p0)
+        next_t, next_p = points[i + 1] if i + 1 < len(points) else (t1, p1)
+        m0 = (p1 - prev_p) / (t1 - prev_t) * (t1 - t0)
+        m1 = (next_p - p0) / (next_t - t0) * (t1 - t0)
+        u2, u3 = u * u, u * u * u
+        pos = ((2 * u3 - 3 * u2 + 1) * p0 + (u3 - 2 * u2 + u) * m0 +
+               (-2 * u3 + 3 * u2) * p1 + (u3 - u2) * m1)
+        # The spline can overshoot the waypoints, keep it within their range
+        low, high = min(p for _, p in points), max(p for _, p in points)
+        return min(max(pos, low), high)
+
+    def positions(self, t: float) -> Dict[int, int]:
+        """Positions of all the channels at :code:`t` seconds from the start"""
+        return {channel: int(round(self._position(points, t)))
+                for channel, points in self.waypoints.items()}
+
+
+class TrajectoryExecutor:
+    """Run a :class:`Trajectory` on an :class:`SC08A` from a scheduler thread
+
+    Every tick of :code:`rate` per second the positions of the trajectory at
+    the planned time of the tick are written with one
+    :meth:`SC08A.set_pos_speeds`. Channels whose position didn't change aren't
+    written. If the thread falls behind by more than a tick, the late ticks are
+    skipped so that the motion stays on time. The delay of each tick from its
+    planned time (slip) is kept for :meth:`status`.
+
+    At 9600 baud a command takes about 4 ms on the line, which limits the rate
+    times the number of channels that are moving.
+
+    Running a new trajectory preempts the current one. If writing fails, the
+    trajectory stops with the state :code:`"error"` and the error in
+    :meth:`status`.
+
+    Args:
+        controller: The :class:`SC08A`
+        lock: Lock for the serial port, shared with the other users of the
+              controller
+        rate: Ticks per second
+
+    """
+    def __init__(self, controller: SC08A, lock: Optional[Lock] = None, rate: float = 20.):
+        self.controller = controller
+        self.lock = lock or Lock()
+        self.rate = rate
+        self._ids = itertools.count(1)
+        self._condition = Condition()
+        self._trajectory: Optional[Trajectory] = None
+        self._thread: Optional[Thread] = None
+        self._status: dict = {"id": None, "state": "idle"}
+        self._slips: List[float] = []
+
+    def run(self, trajectory: Trajectory) -> int:
+        """Start :code:`trajectory` now, preempting a running one. Returns its id."""
+        preempted = self._status["id"] if self.cancel("preempted") else None
+        traj_id = next(self._ids)
+        with self._condition:
+            self._trajectory = trajectory
+            self._slips = []
+            self._status = {"id": traj_id, "state": "running",
+                            "planned_duration": trajectory.duration,
+                            "ticks": 0, "skipped": 0, "writes": 0, "preempted": preempted}
+        self._thread = Thread(target=self._run_loop, args=(trajectory,), daemon=True)
+        self._thread.start()
+        return traj_id
+
+    def cancel(self, state: str = "cancelled"):
+        """Stop the running trajectory. The motors stay at the last written positions."""
+        with self._condition:
+            if self._trajectory is None:
+                return False
+            self._trajectory = None
+            self._status["state"] = state
+            self._condition.notify_all()
+        self._thread.join()
+        self._thread = None
+        return True
+
+    def _run_loop(self, trajectory: Trajectory):
+        try:
+            self._run_ticks(trajectory)
+        except Exception as e:
+            print(f"Trajectory failed: {e!r}")
+            with self._condition:
+                if self._trajectory is trajectory:
+                    self._trajectory = None
+                    self._status["state"] = "error"
+                    self._status["error"] = repr(e)
+
+    def _run_ticks(self, trajectory: Trajectory):
+        period = 1 / self.rate
+        start = time.perf_counter()
+        last: Dict[int, int] = {}
+        tick = 0
+        while True:
+            planned = start + tick * period
+            with self._condition:
+                # Wakes up early on cancel
+                self._condition.wait_for(lambda: self._trajectory is not trajectory,
+                                         max(planned - time.perf_counter(), 0))
+                if self._trajectory is not trajectory:
+                    return
+            actual = time.perf_counter()
+            t = min(tick * period, trajectory.duration)
+            positions = trajectory.positions(t)
+            commands = []
+            for channel, pos in positions.items():
+                if pos == last.get(channel):
+                    continue
+                if trajectory.speed is not None:
+                    speed = trajectory.speed
+                elif channel in last:
+                    distance = abs(pos - last[channel])
+                    speed = min(max(math.ceil(distance / (self.controller.speed_scale * period)),
+                                    1), 255)
+                else:
+                    # Get to the start as fast as possible
+                    speed = 0
+                commands.append((channel, pos, speed))
+                last[channel] = pos
+            if commands:
+                with self.lock:
+                    self.controller.set_pos_speeds(commands)
+            with self._condition:
+                self._slips.append(actual - planned)
+                status = self._status
+                status["ticks"] += 1
+                status["writes"] += bool(commands)
+                status["elapsed"] = actual - start
+                status["last_tick"] = {"planned": planned - start, "actual": actual - start}
+                if t >= trajectory.duration:
+                    self._trajectory = None
+                    status["state"] = "done"
+                    status["actual_duration"] = time.perf_counter() - start
+                    return
+            next_tick = tick + 1
+            behind = int((time.perf_counter() - start) / period)
+            if behind > next_tick:
+                with self._condition:
+                    self._status["skipped"] += behind - next_tick
+                next_tick = behind
+            tick = next_tick
+
+    def status(self) -> dict:
+        """State of the last trajectory with its planned against actual timing
+
+        The slips are the delays of the ticks from their planned times in
+        seconds. :code:`skipped` is the number of ticks dropped to catch up.
+
+        """
+        with self._condition:
+            status = dict(self._status)
+            slips = sorted(self._slips)
+        if slips:
+            status["slip"] = {"mean": sum(slips) / len(slips),
+                              "p50": slips[len(slips) // 2],
+                              "p95": slips[min(int(len(slips) * .95), len(slips) - 1)],
+                              "max": slips[-1]}
+        return status
+
+
 class Service:
     """Flask service for SCO8A Servo Controller
 
+    Position commands are queued to a :class:`SerialWriter` and the requests
+    return with the command id, which can be checked with
+    :code:`/command_status`. All access to the serial port goes through
+    :code:`serial_lock`.
+
+    A :class:`Trajectory` can be uploaded as JSON with
+    :code:`/run_trajectory?trajectory=...` and is run by a
+    :class:`TrajectoryExecutor`. :code:`/trajectory_status` reports its
+    planned against actual timing and :code:`/cancel_trajectory` stops it.
+
     Args:
         pins: List of pins to run on the service
         port: The port for the servo controller
@@ -151,66 +741,177 @@ class Service:
     def __init__(self, pins: List[int], port: str, baudrate: Optional[int] = None):
         self.pins = pins
         self.port = port
-        self.badurate = baudrate or 9600
+        self.baudrate = baudrate or 9600
+        self.serial_lock = Lock()
+        self.controller: Optional[SC08A] = None
+        self.writer: Optional[SerialWriter] = None
+        self.executor: Optional[TrajectoryExecutor] = None
         self.app = Flask("Servo")
         self.init_routes()
 
     def init_controller(self):
+        """Open the controller, replacing the current one
+
+        The writer and a running trajectory of the current controller are
+        stopped first so that nothing writes to it any more.
+
+        """
+        if self.executor is not None:
+            self.executor.cancel()
+        if self.writer is not None:
+            self.writer.stop()
+        if self.controller is not None:
+            with self.serial_lock:
+                self.controller.close()
         self.controller = SC08A(self.port, self.baudrate)
-        self.controller.init_all_motors()
+        with self.serial_lock:
+            self.controller.init_all_motors()
+        self.writer = SerialWriter(self.controller, self.serial_lock)
+        self.executor = TrajectoryExecutor(self.controller, self.serial_lock)
 
     def init_routes(self):
-        @self.app.route("/set_pos", methods=["GET"])
-        def _set_pos():
-            if "pin" not in request.args:
-                return "Pin not given"
-            if "pos" not in request.args:
-                return "pos (position) not given"
-            if "speed" not in request.args:
+        self.handlers = {"/set_pos": self._set_pos,
+                         "/get_pos": self._get_pos,
+                         "/get_all_pos": self._get_all_pos,
+                         "/reset": self._reset,
+                         "/reset_all": self._reset_all,
+                         "/close": self._close,
+                         "/start": self._start,
+                         "/command_status": self._command_status,
+                         "/run_trajectory": self._run_trajectory,
+                         "/cancel_trajectory": self._cancel_trajectory,
+                         "/trajectory_status": self._trajectory_status}
+        for path, handler in self.handlers.items():
+            self.app.add_url_rule(path, path, self._flask_view(handler), methods=["GET"])
+
+    @staticmethod
+    def _flask_view(handler):
+        def _view():
+            return handler(request.args)
+        return _view
+
+    def _set_pos(self, args):
+        if "pin" not in args:
+            return "Pin not given"
+        if "pos" not in args:
+            return "pos (position) not given"
+        if self.writer is None:
+            return "The controller is not started. /start it first"
+        try:
+            if "speed" not in args:
                 print("speed not given. Will use 50")
                 speed = 50
             else:
-                speed = int(request.args.get("speed"))
-            pin = int(request.args.get("pin"))
-            pos = int(request.args.get("pos"))
-            self.controller.set_pos_speed(pin, pos, speed)
-            return f"Setting position for motor: {pin} at: {pos} and speed: {speed}"
-
-        @self.app.route("/get_pos", methods=["GET"])
-        def _get_pos():
-            if "pin" not in request.args:
-                return "Pin not given"
-            pin = int(request.args.get("pin"))
+                speed = int(args.get("speed"))
+            pin = int(args.get("pin"))
+            pos = int(args.get("pos"))
+            cmd_id = self.writer.submit(pin, pos, speed)
+        except ValueError as e:
+            return f"Invalid command: {e}"
+        except RuntimeError:
+            return "The controller is closed. /start it first"
+        return f"Command {cmd_id}: Setting position for motor: {pin} at: {pos} and speed: {speed}"
+
+    def _command_status(self, args=None):
+        if self.writer is None:
+            return "The controller is not started. /start it first"
+        return self.writer.status()
+
+    def _run_trajectory(self, args):
+        if "trajectory" not in args:
+            return "Trajectory not given"
+        if self.executor is None:
+            return "The controller is not started. /start it first"
+        try:
+            trajectory = Trajectory.from_json(args["trajectory"])
+        except ValueError as e:
+            return str(e)
+        traj_id = self.executor.run(trajectory)
+        return f"Trajectory {traj_id}: Running for {trajectory.duration}s " +\
+            f"on motors {sorted(trajectory.waypoints)}"
+
+    def _cancel_trajectory(self, args=None):
+        if self.executor is None:
+            return "The controller is not started. /start it first"
+        if self.executor.cancel():
+            return "Cancelled the trajectory"
+        return "No trajectory running"
+
+    def _trajectory_status(self, args=None):
+        if self.executor is None:
+            return "The controller is not started. /start it first"
+        return self.executor.status()
+
+    def _get_pos(self, args):
+        if "pin" not in args:
+            return "Pin not given"
+        if self.controller is None:
+            return "The controller is not started. /start it first"
+        pin = int(args.get("pin"))
+        with self.serial_lock:
             return str(self.controller.get_pos(pin))
 
-        @self.app.route("/reset", methods=["GET"])
-        def _reset():
-            if "pin" not in request.args:
-                return "Pin not given"
-            pin = int(request.args.get("pin"))
+    def _get_all_pos(self, args):
+        """Positions of :code:`pins` (comma separated) or all the pins as JSON"""
+        if self.controller is None:
+            return "The controller is not started. /start it first"
+        pins = [*map(int, args["pins"].split(","))] if "pins" in args else self.pins
+        with self.serial_lock:
+            return self.controller.get_positions(pins)
+
+    def _reset(self, args):
+        if "pin" not in args:
+            return "Pin not given"
+        if self.controller is None:
+            return "The controller is not started. /start it first"
+        pin = int(args.get("pin"))
+        with self.serial_lock:
             self.controller.off_motor(pin)
-            return f"Turning motor {pin} OFF"
+        return f"Turning motor {pin} OFF"
 
-        @self.app.route("/reset_all", methods=["GET"])
-        def _reset_all():
+    def _reset_all(self, args=None):
+        if self.controller is None:
+            return "The controller is not started. /start it first"
+        with self.serial_lock:
             for pin in self.pins:
                 self.controller.off_motor(pin)
-            return "Issued OFF command for all motors"
-
-        @self.app.route("/close", methods=["GET"])
-        def _close():
-            _reset_all()
+        return "Issued OFF command for all motors"
+
+    def _close(self, args=None):
+        if self.controller is None:
+            return "The controller is not started. /start it first"
+        self.executor.cancel()
+        self.writer.stop()
+        self._reset_all()
+        with self.serial_lock:
             self.controller.shutdown()
-            return "Stopped all motors and turned off the controller"
+        return "Stopped all motors and turned off the controller"
 
-        @self.app.route("/start", methods=["GET"])
-        def _start():
-            self.init_controller()
-            return "Initialized the controller"
+    def _start(self, args=None):
+        self.init_controller()
+        return "Initialized the controller"
 
     def start(self):
         serving.run_simple("0.0.0.0", 2233, self.app, threaded=True)
 
+    def start_async(self):
+        """Start the service with an asyncio (aiohttp) server instead of werkzeug
+
+        The handlers run on a single worker thread so that the requests don't
+        each take up a thread and the serial port is accessed by only one of
+        them at a time.
+
+        """
+        # async_server is in streaming/, which the repo_dirs helper of the
+        # two_dof_arm scripts puts on sys.path
+        repo_dirs = Path(__file__).resolve().parent.parent / "two_dof_arm" / "repo_dirs.py"
+        runpy.run_path(str(repo_dirs))["add"]("streaming")
+        import async_server
+
+        app = async_server.web.Application()
+        async_server.add_handler_routes(app, self.handlers, ThreadPoolExecutor(max_workers=1))
+        async_server.run(app, 2233)
+
 
 def test_servo(servo, channel, pos_a=500, pos_b=8000, spd_a=100, spd_b=200):
     """Test a servo motor with an SC08A controller
@@ -237,12 +938,70 @@ def test_servo(servo, channel, pos_a=500, pos_b=8000, spd_a=100, spd_b=200):
             time.sleep(.1)
 
 
+def benchmark_bulk(servo, channels=(1, 2, 3, 4, 5, 6, 7, 8), repeats=1000):
+    """Compare :meth:`SC08A.set_pos_speeds` with one :meth:`SC08A.set_pos_speed` per channel
+
+    Prints the time spent per move, the number of writes and bytes, and the
+    time between the first and the last channel getting its packet on the
+    line at the baudrate of :code:`servo`. Use a :code:`loop://` port to
+    measure without a controller.
+
+    Args:
+        servo: :class:`SC08A` instance
+        channels: Channels to move together
+        repeats: Number of moves to time
+
+    """
+    write = servo.port.write
+    counts = [0, 0]
+
+    def _counting_write(data):
+        counts[0] += 1
+        counts[1] += len(data)
+        return write(data)
+
+    def _per_call(commands):
+        for command in commands:
+            servo.set_pos_speed(*command)
+
+    servo.port.write = _counting_write
+    try:
+        for name, same in (("different targets", False), ("same target", True)):
+            commands = [(ch, 4000 if same else 1000 + 500 * ch, 100) for ch in channels]
+            for label, move in (("per call", _per_call), ("bulk", servo.set_pos_speeds)):
+                counts[:] = [0, 0]
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    move(commands)
+                    servo.port.reset_input_buffer()
+                duration = (time.perf_counter() - start) / repeats
+                writes, num_bytes = counts[0] // repeats, counts[1] // repeats
+                skew = (num_bytes - 4) * 10 / servo.baudrate
+                print(f"{name}, {label}: {duration * 1e6:.1f} us per move, {writes} writes, "
+                      f"{num_bytes} bytes, {skew * 1000:.1f} ms from first to last channel "
+                      f"at {servo.baudrate} baud")
+    finally:
+        servo.port.write = write
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument("--pins", required=True, help="List of comma separated pins")
+    parser.add_argument("--pins",
+                        help="List of comma separated pins. Required except with --benchmark")
     parser.add_argument("--port", required=True, help="The serial port")
-    parser.add_argument("--baudrate", help="Baudrate for the serial port")
+    parser.add_argument("--baudrate", type=int, help="Baudrate for the serial port")
+    parser.add_argument("--asyncio", action="store_true", help="Use the asyncio server")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Benchmark bulk against per channel commands on the port and exit")
     args = parser.parse_args()
+    if args.benchmark:
+        benchmark_bulk(SC08A(args.port, args.baudrate))
+        sys.exit(0)
+    if not args.pins:
+        parser.error("--pins is required to run the service")
     pins = args.pins.split(",")
     service = Service([*map(int, pins)], args.port, args.baudrate)
-    service.start()
+    if args.asyncio:
+        service.start_async()
+    else:
+        service.start()
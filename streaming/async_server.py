@@ -0,0 +1,163 @@
+from typing import Callable, Dict, Optional
+from concurrent.futures import Executor
+import asyncio
+
+from aiohttp import web
+
+from frame_cache import (EncodedFrameCache, LatestFrame, binary_frame, frame_request,
+                         parse_variant)
+
+
+boundary = "frame"
+
+
+class AsyncFrameNotifier:
+    """Let asyncio tasks wait for the frames published to a :class:`LatestFrame`
+
+    Instead of blocking a thread on the :code:`threading.Condition`, each waiter
+    awaits an :class:`asyncio.Event` which is set from the capture thread via
+    :meth:`asyncio.AbstractEventLoop.call_soon_threadsafe` and replaced with a
+    fresh one for every frame.
+
+    Args:
+        latest: The :class:`LatestFrame` to which the capture thread publishes
+
+    """
+    def __init__(self, latest: LatestFrame):
+        self.latest = latest
+        self._loop = None
+        self._event = None
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        """Attach to the running event loop. Must be called from the loop."""
+        self._loop = loop
+        self._event = asyncio.Event()
+        self.latest.add_listener(self._notify)
+
+    def _notify(self):
+        self._loop.call_soon_threadsafe(self._set)
+
+    def _set(self):
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+    async def wait(self, previous: Optional[int] = None, timeout: Optional[float] = None):
+        """Async version of :meth:`LatestFrame.wait`"""
+        count, timestamp, frame = self.latest.snapshot()
+        if previous is not None and count != previous and frame is not None:
+            return count, timestamp, frame
+        start = count
+        deadline = None if timeout is None else self._loop.time() + timeout
+        while True:
+            event = self._event
+            count, timestamp, frame = self.latest.snapshot()
+            if count != start and count != previous:
+                return count, timestamp, frame
+            remaining = None if deadline is None else deadline - self._loop.time()
+            if remaining is not None and remaining <= 0:
+                return None, None, None
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None, None, None
+
+
+def add_frame_routes(app: web.Application, latest: LatestFrame, cache: EncodedFrameCache,
+                     executor: Optional[Executor] = None):
+    """Add :code:`/get_frame`, :code:`/frame` and :code:`/stream` routes to an aiohttp app
+
+    The routes behave as the ones of :class:`frame_server.FrameServer`. Encoding
+    is done in :code:`executor` (the default executor of the loop if not given)
+    so that it doesn't block the loop.
+
+    Args:
+        app: The aiohttp application
+        latest: :class:`LatestFrame` of the capture thread
+        cache: :class:`EncodedFrameCache` shared with other routes
+        executor: Executor to encode in
+
+    """
+    notifier = AsyncFrameNotifier(latest)
+
+    async def _startup(app):
+        notifier.attach(asyncio.get_running_loop())
+
+    async def _encode(func, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    async def _get_frame(request):
+        try:
+            variant = parse_variant(request.query)
+        except ValueError as e:
+            return web.Response(text=str(e), status=400)
+        count, timestamp, frame = await notifier.wait()
+        return web.Response(body=await _encode(cache.b64, count, frame, variant))
+
+    async def _frame(request):
+        try:
+            after, timeout = frame_request(request.query, request.headers)
+        except ValueError as e:
+            return web.Response(text=str(e), status=400)
+        count, timestamp, frame = await notifier.wait(after, timeout)
+        if frame is None:
+            return web.Response(status=304)
+        try:
+            data, content_type, headers = await _encode(
+                binary_frame, cache, count, timestamp, frame, request.query.get("format", "jpg"),
+                parse_variant(request.query))
+        except ValueError as e:
+            return web.Response(text=str(e), status=400)
+        return web.Response(body=data, content_type=content_type, headers=headers)
+
+    async def _stream(request):
+        try:
+            variant = parse_variant(request.query)
+        except ValueError as e:
+            return web.Response(text=str(e), status=400)
+        response = web.StreamResponse()
+        response.content_type = "multipart/x-mixed-replace"
+        response.headers["Content-Type"] = f"multipart/x-mixed-replace; boundary={boundary}"
+        await response.prepare(request)
+        count = None
+        while True:
+            count, timestamp, frame = await notifier.wait(count)
+            buf = await _encode(cache.jpeg, count, frame, variant)
+            await response.write((f"--{boundary}\r\nContent-Type: image/jpeg\r\n"
+                                  f"Content-Length: {len(buf)}\r\n\r\n").encode() + buf + b"\r\n")
+
+    app.on_startup.append(_startup)
+    app.router.add_get("/get_frame", _get_frame)
+    app.router.add_get("/frame", _frame)
+    app.router.add_get("/stream", _stream)
+
+
+def add_handler_routes(app: web.Application, handlers: Dict[str, Callable],
+                       executor: Optional[Executor] = None):
+    """Add GET routes for handlers which take the request parameters and return text
+
+    A handler may also return a :class:`dict`, which is sent as JSON like
+    Flask does. The handlers are the same ones used for the Flask routes. They are run in
+    :code:`executor` so that blocking serial I/O doesn't block the loop. Pass a
+    single worker executor to serialize access to a shared device.
+
+    Args:
+        app: The aiohttp application
+        handlers: Mapping of path to handler
+        executor: Executor to run the handlers in
+
+    """
+    def _route(handler):
+        async def _handle(request):
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(executor, handler, request.query)
+            if isinstance(result, dict):
+                return web.json_response(result)
+            return web.Response(text=str(result))
+        return _handle
+
+    for path, handler in handlers.items():
+        app.router.add_get(path, _route(handler))
+
+
+def run(app: web.Application, port: int):
+    web.run_app(app, host="0.0.0.0", port=port)
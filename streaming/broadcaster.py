@@ -0,0 +1,126 @@
+from collections import deque
+from threading import Condition, Lock, Thread
+import socket
+
+from picamera2.outputs import Output
+
+
+class Subscriber:
+    """A TCP client of :class:`H264Broadcaster` with its own bounded queue.
+
+    Frames are sent from a separate thread so that a slow client never blocks
+    the encoder. A new subscriber starts at the next keyframe. If the queue
+    fills up, the queued frames are dropped and sending resumes at the next
+    keyframe.
+
+    Args:
+        conn: The connected socket
+        addr: Address of the client
+        max_queue: Maximum number of frames queued for the client
+
+    """
+    def __init__(self, conn, addr, max_queue: int = 30):
+        self.conn = conn
+        self.addr = addr
+        self.max_queue = max_queue
+        self.closed = False
+        self.dropped = 0
+        self._queue: deque = deque()
+        self._waiting_for_keyframe = True
+        self._condition = Condition()
+        self._thread = Thread(target=self._send_loop, daemon=True)
+        self._thread.start()
+
+    def push(self, frame: bytes, keyframe: bool):
+        with self._condition:
+            if self._waiting_for_keyframe:
+                if not keyframe:
+                    return
+                self._waiting_for_keyframe = False
+            if len(self._queue) >= self.max_queue:
+                self._queue.clear()
+                self.dropped += 1
+                if not keyframe:
+                    self._waiting_for_keyframe = True
+                    return
+            self._queue.append(frame)
+            self._condition.notify()
+
+    def _send_loop(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue or self.closed)
+                if self.closed:
+                    break
+                frame = self._queue.popleft()
+            try:
+                self.conn.sendall(frame)
+            except OSError:
+                break
+        self.close()
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify()
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+
+
+class H264Broadcaster(Output):
+    """A :class:`picamera2.outputs.Output` that fans out one H.264 stream to many TCP clients
+
+    The encoder should repeat the SPS and PPS headers with each keyframe (see
+    :code:`repeat` of :class:`picamera2.encoders.H264Encoder`) so that the
+    clients joining late can start decoding at the next keyframe.
+
+    Args:
+        hostname: Hostname to listen on
+        port: Port to listen on
+        max_queue: Maximum number of frames queued per client
+
+    """
+    def __init__(self, hostname: str, port: int, max_queue: int = 30):
+        super().__init__()
+        self.max_queue = max_queue
+        self._subscribers = []
+        self._lock = Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((hostname, port))
+        self.sock.listen()
+        self._accept_thread = Thread(target=self._accept_loop, daemon=True)
+        self._accept_thread.start()
+
+    @property
+    def subscribers(self):
+        with self._lock:
+            return [s for s in self._subscribers if not s.closed]
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            print(f"Subscriber connected from {addr}")
+            with self._lock:
+                self._subscribers.append(Subscriber(conn, addr, self.max_queue))
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        data = bytes(frame)
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if not s.closed]
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.push(data, keyframe)
+
+    def close(self):
+        self.sock.close()
+        with self._lock:
+            for subscriber in self._subscribers:
+                subscriber.close()
+            self._subscribers = []
@@ -1,10 +1,15 @@
-import base64
+import argparse
+from threading import Thread
+import time
 import cv2 as cv
 
-from flask import Flask
+from flask import Flask, Response, request
 from werkzeug import serving
 from common_pyutil.monitor import Timer
 
+from frame_cache import (EncodedFrameCache, LatestFrame, binary_frame, frame_request,
+                         parse_variant)
+
 
 def gstreamer_pipeline(width=1280, height=720, flip_180=False):
     args = ["libcamerasrc", f"video/x-raw, width={width}, height={height}"]
@@ -18,29 +23,86 @@ timer = Timer()
 
 
 class FrameServer:
+    # Consecutive failed reads after which the camera is taken to be gone
+    max_read_failures = 50
+
     def __init__(self, width, height, port=8080):
         self._gst_pipeline = gstreamer_pipeline(width, height, flip_180=True)
         self._cap = cv.VideoCapture(self._gst_pipeline, cv.CAP_GSTREAMER)
+        self._latest = LatestFrame()
+        self._running = True
+        self._thread = Thread(target=self._thread_func, daemon=True)
+        self._cache = EncodedFrameCache()
         self.port = port
         self.app = Flask("Frame Server")
 
     def start(self):
         self.init_routes()
-        serving.run_simple("0.0.0.0", self.port, self.app)
+        self._thread.start()
+        serving.run_simple("0.0.0.0", self.port, self.app, threaded=True)
+
+    def start_async(self):
+        """Start the FrameServer with an asyncio server instead of werkzeug."""
+        import async_server
+        app = async_server.web.Application()
+        async_server.add_frame_routes(app, self._latest, self._cache)
+        self._thread.start()
+        async_server.run(app, self.port)
+
+    def _thread_func(self):
+        failures = 0
+        while self._running:
+            status, img = self._cap.read()
+            if not status:
+                failures += 1
+                if failures >= self.max_read_failures:
+                    print(f"Could not read from the camera {failures} times. Stopping capture.")
+                    break
+                time.sleep(.1)
+                continue
+            failures = 0
+            self._latest.publish(img)
 
     def init_routes(self):
         @self.app.route("/get_frame", methods=["GET"])
         def __get_frame():
+            try:
+                variant = parse_variant(request.args)
+            except ValueError as e:
+                return str(e), 400
             with timer:
-                status, img = self._cap.read()
+                count, timestamp, img = self._latest.wait()
             print("read time", timer.time)
             with timer:
-                status, buf = cv.imencode(".jpg", img)
+                data = self._cache.b64(count, img, variant)
             print("encode time", timer.time)
-            data = base64.b64encode(buf)
             return data
 
+        @self.app.route("/frame", methods=["GET"])
+        def __frame():
+            try:
+                after, timeout = frame_request(request.args, request.headers)
+            except ValueError as e:
+                return str(e), 400
+            count, timestamp, img = self._latest.wait(after, timeout)
+            if img is None:
+                return Response(status=304)
+            try:
+                data, mimetype, headers = binary_frame(self._cache, count, timestamp, img,
+                                                       request.args.get("format", "jpg"),
+                                                       parse_variant(request.args))
+            except ValueError as e:
+                return str(e), 400
+            return Response(data, mimetype=mimetype, headers=headers)
+
 
 if __name__ == '__main__':
-    server = FrameServer(640, 480)
-    server.start()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("--asyncio", action="store_true", help="Use the asyncio server")
+    args = parser.parse_args()
+    server = FrameServer(640, 480, port=args.port)
+    if args.asyncio:
+        server.start_async()
+    else:
+        server.start()
@@ -4,8 +4,8 @@ import time
 import cv2 as cv
 
 
-def main(host, port):
-    cap = cv.VideoCapture(f"http://{host}:{port}/stream.m3u8")
+def main(host, port, path):
+    cap = cv.VideoCapture(f"http://{host}:{port}/{path}")
     status, img = cap.read()
     i = 0
     try:
@@ -29,5 +29,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("host")
     parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("--path", default="hls/stream.m3u8",
+                        help="Path of the playlist. Use \"stream.m3u8\" for \"ffmpeg\" method")
     args = parser.parse_args()
-    main(args.host, args.port)
+    main(args.host, args.port, args.path)
@@ -0,0 +1,330 @@
+from typing import NamedTuple, Optional
+from collections import OrderedDict
+from threading import Condition, Event, Lock
+import time
+import math
+import base64
+
+import cv2 as cv
+
+
+class Variant(NamedTuple):
+    """A resolution, quality and colour variant of the frames requested by a client
+
+    :code:`width` and :code:`height` of :code:`None` keep the aspect ratio
+    if the other one is given and the capture size if neither is.
+
+    """
+    width: Optional[int] = None
+    height: Optional[int] = None
+    quality: Optional[int] = None
+    gray: bool = False
+
+
+def parse_variant(args):
+    """Get the :class:`Variant` from the request parameters
+
+    The parameters are :code:`width`, :code:`height`, :code:`quality` (JPEG
+    quality 1-100) and :code:`gray`. Returns :code:`None` if none are given
+    so that the default variant shares the cache entries. The size is limited
+    to that of the frames later by :func:`fit_variant`.
+
+    """
+    def _int(name):
+        return int(args.get(name)) if name in args else None
+    variant = Variant(_int("width"), _int("height"), _int("quality"),
+                      args.get("gray", "").lower() in {"1", "true", "yes"})
+    if variant.quality is not None and not 1 <= variant.quality <= 100:
+        raise ValueError("quality must be in 1-100")
+    if any(size is not None and size <= 0 for size in (variant.width, variant.height)):
+        raise ValueError("width and height must be positive")
+    return None if variant == Variant() else variant
+
+
+def fit_variant(variant: Optional[Variant], shape):
+    """Limit the size of the variant to the frame :code:`shape`
+
+    Frames are never scaled up, so a larger size is the same as the frame
+    size and shares its cache entries.
+
+    """
+    if variant is None or not (variant.width or variant.height):
+        return variant
+    height, width = shape[:2]
+    new_width = variant.width and min(variant.width, width)
+    new_height = variant.height and min(variant.height, height)
+    if (new_width or width, new_height or height) == (width, height):
+        new_width = new_height = None
+    variant = variant._replace(width=new_width, height=new_height)
+    return None if variant == Variant() else variant
+
+
+def make_variant(frame, variant: Optional[Variant]):
+    """Resize and convert the frame as required by the variant"""
+    if variant is None:
+        return frame
+    height, width = frame.shape[:2]
+    if variant.width or variant.height:
+        new_width = variant.width or max(1, round(width * variant.height / height))
+        new_height = variant.height or max(1, round(height * variant.width / width))
+        if (new_width, new_height) != (width, height):
+            interpolation = cv.INTER_AREA if new_width < width else cv.INTER_LINEAR
+            frame = cv.resize(frame, (new_width, new_height), interpolation=interpolation)
+    if variant.gray and frame.ndim == 3:
+        code = cv.COLOR_BGRA2GRAY if frame.shape[2] == 4 else cv.COLOR_BGR2GRAY
+        frame = cv.cvtColor(frame, code)
+    return frame
+
+
+def encode_jpeg(frame, quality=None):
+    params = [] if quality is None else [cv.IMWRITE_JPEG_QUALITY, quality]
+    status, buf = cv.imencode(".jpg", frame, params)
+    if not status:
+        raise ValueError("Could not encode frame")
+    return buf.tobytes()
+
+
+class LatestFrame:
+    """Hold the most recently captured frame with its sequence number and capture time.
+
+    The capture thread calls :meth:`publish` and any number of reader threads
+    can :meth:`wait` for a frame newer than the one they already have.
+
+    """
+    def __init__(self):
+        self.condition = Condition()
+        self.count = 0
+        self.timestamp = None
+        self.frame = None
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Add a callback with no arguments to be called after each frame is published"""
+        self._listeners.append(callback)
+
+    def publish(self, frame, timestamp=None, count=None):
+        """Publish a frame and wake up the waiters
+
+        Args:
+            frame: The frame
+            timestamp: Capture time, now if not given
+            count: Sequence number of the frame if it comes from elsewhere,
+                   like a :class:`shm_ring.SharedFrameRing`. Incremented by
+                   one if not given.
+
+        """
+        with self.condition:
+            self.count = self.count + 1 if count is None else count
+            self.timestamp = timestamp or time.time()
+            self.frame = frame
+            self.condition.notify_all()
+        for callback in self._listeners:
+            callback()
+
+    def snapshot(self):
+        """Return the current sequence number, capture timestamp and frame without waiting"""
+        with self.condition:
+            return self.count, self.timestamp, self.frame
+
+    def wait(self, previous=None, timeout=None):
+        """Wait for a frame newer than the sequence number :code:`previous`
+
+        If :code:`previous` is :code:`None` wait for the next frame.
+
+        Returns:
+            A tuple of sequence number, capture timestamp and frame. All three
+            are :code:`None` if no newer frame arrived within :code:`timeout`.
+
+        """
+        with self.condition:
+            if previous is not None and self.count != previous and self.frame is not None:
+                return self.count, self.timestamp, self.frame
+            start = self.count
+            newer = self.condition.wait_for(
+                lambda: self.count != start and self.count != previous, timeout)
+            if not newer:
+                return None, None, None
+            return self.count, self.timestamp, self.frame
+
+
+class EncodedFrameCache:
+    """A small bounded cache of encoded frames shared by all the clients.
+
+    Entries are keyed by the frame sequence number (the :code:`_count` of the
+    frame server), the format and the :class:`Variant`, so that each captured
+    frame is resized and encoded at most once per format and variant no matter
+    how many clients request it. If a frame is
+    being encoded when another request for it arrives, the second request
+    waits for the first one to finish instead of encoding again.
+
+    The sequence numbers must not repeat, so if the capture is replaced by one
+    which counts from the start again, :meth:`clear` the cache.
+
+    Args:
+        maxsize: Maximum number of encoded entries to keep
+
+    """
+    def __init__(self, maxsize: int = 32):
+        self.maxsize = maxsize
+        self._entries: OrderedDict = OrderedDict()
+        self._encode_times = {}
+        self._pending = {}
+        self._lock = Lock()
+
+    def get(self, key, encode):
+        """Get the entry for :code:`key`, calling :code:`encode` to create it if required
+
+        Args:
+            key: A hashable key, usually :code:`(seq, format)`
+            encode: A callable with no arguments which returns the encoded data
+
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            event = self._pending.get(key)
+            owner = event is None
+            if owner:
+                event = self._pending[key] = Event()
+        if not owner:
+            event.wait()
+            with self._lock:
+                if key in self._entries:
+                    return self._entries[key]
+            return self.get(key, encode)
+        try:
+            start = time.time()
+            data = encode()
+            with self._lock:
+                self._entries[key] = data
+                self._encode_times[key] = time.time() - start
+                while len(self._entries) > self.maxsize:
+                    old_key, _ = self._entries.popitem(last=False)
+                    self._encode_times.pop(old_key, None)
+            return data
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            event.set()
+
+    def clear(self):
+        """Drop all the encoded entries, e.g. when the capture is replaced"""
+        with self._lock:
+            self._entries.clear()
+            self._encode_times.clear()
+
+    def encode_time(self, key):
+        """Time taken to encode the entry for :code:`key` in seconds, if it's cached"""
+        with self._lock:
+            return self._encode_times.get(key)
+
+    def frame(self, seq, frame, variant=None):
+        """Return the frame number :code:`seq` resized and converted for :code:`variant`"""
+        variant = fit_variant(variant, frame.shape)
+        if variant is None:
+            return frame
+        return self.get((seq, "frame", variant), lambda: make_variant(frame, variant))
+
+    def jpeg(self, seq, frame, variant=None):
+        """Return JPEG encoded bytes for frame number :code:`seq`"""
+        variant = fit_variant(variant, frame.shape)
+        quality = variant.quality if variant else None
+        return self.get((seq, "jpg", variant),
+                        lambda: encode_jpeg(self.frame(seq, frame, variant), quality))
+
+    def b64(self, seq, frame, variant=None):
+        """Return base64 encoded JPEG bytes for frame number :code:`seq`"""
+        variant = fit_variant(variant, frame.shape)
+        return self.get((seq, "b64", variant),
+                        lambda: base64.b64encode(self.jpeg(seq, frame, variant)))
+
+    def raw(self, seq, frame, variant=None):
+        """Return the raw bytes of the frame array for frame number :code:`seq`"""
+        variant = fit_variant(variant, frame.shape)
+        return self.get((seq, "raw", variant), lambda: self.frame(seq, frame, variant).tobytes())
+
+
+def requested_after(args, headers):
+    """Get the sequence number of the frame a client already has
+
+    It's given either as the :code:`after` request parameter or as the ETag in an
+    :code:`If-None-Match` header.
+
+    """
+    if "after" in args:
+        try:
+            return int(args.get("after"))
+        except ValueError:
+            raise ValueError(f"Invalid after {args.get('after')!r}, must be a frame number")
+    etag = headers.get("If-None-Match")
+    if etag and etag.strip('W/"').isdigit():
+        return int(etag.strip('W/"'))
+    return None
+
+
+# Longest a request can wait for the next frame or status, so that the
+# waiting requests can't hold on to the server threads
+MAX_WAIT = 30.
+
+
+def wait_timeout(args, default=1.):
+    """Get the :code:`timeout` request parameter in seconds, clamped to :data:`MAX_WAIT`
+
+    Raises:
+        ValueError: With the message for the client if it's not a finite
+                    non-negative number
+
+    """
+    try:
+        timeout = float(args.get("timeout", default))
+    except ValueError:
+        timeout = math.nan
+    if not math.isfinite(timeout) or timeout < 0:
+        raise ValueError(f"Invalid timeout {args.get('timeout')!r}, must be in seconds")
+    return min(timeout, MAX_WAIT)
+
+
+def frame_request(args, headers):
+    """Get the :func:`requested_after` and the :code:`timeout` of a :code:`/frame` request
+
+    Raises:
+        ValueError: With the message for the client if either is invalid
+
+    """
+    return requested_after(args, headers), wait_timeout(args)
+
+
+def binary_frame(cache, seq, timestamp, frame, fmt="jpg", variant=None):
+    """Encode a frame for a binary response.
+
+    Args:
+        cache: :class:`EncodedFrameCache` to get the encoded data from
+        seq: Frame sequence number
+        timestamp: Capture timestamp of the frame
+        frame: The frame array
+        fmt: One of :code:`jpg` or :code:`raw`
+        variant: Optional :class:`Variant` of the frame
+
+    Returns:
+        A tuple of data, content type and response headers
+
+    """
+    variant = fit_variant(variant, frame.shape)
+    headers = {"X-Frame-Seq": str(seq),
+               "X-Frame-Timestamp": f"{timestamp:.6f}",
+               "ETag": f'"{seq}"',
+               "Cache-Control": "no-cache"}
+    if fmt == "jpg":
+        data = cache.jpeg(seq, frame, variant)
+        content_type = "image/jpeg"
+    elif fmt == "raw":
+        data = cache.raw(seq, frame, variant)
+        content_type = "application/octet-stream"
+        shape = cache.frame(seq, frame, variant).shape
+        headers["X-Frame-Shape"] = ",".join(map(str, shape))
+        headers["X-Frame-Dtype"] = str(frame.dtype)
+    else:
+        raise ValueError(f"Unknown format {fmt}")
+    headers["X-Encode-Time"] = f"{cache.encode_time((seq, fmt, variant)) or 0:.6f}"
+    return data, content_type, headers
@@ -0,0 +1,149 @@
+from typing import Dict, Optional
+from threading import Event, Thread
+
+import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
+import cv2 as cv
+
+from frame_cache import LatestFrame
+
+
+class FrameClient:
+    """A client for the binary :code:`/frame` endpoint of the frame servers.
+
+    All requests go through one pooled keep-alive :class:`requests.Session`. When
+    started, a fetch thread keeps the request for frame N+1 in flight while a
+    decode thread decodes frame N, so that the caller only ever waits for its
+    own processing. Both hand-offs keep only the latest item, so a slow caller
+    gets the newest frame and stale ones are dropped.
+
+    Args:
+        host: Remote host
+        port: Remote port
+        params: Extra request parameters for :code:`/frame`
+        pool_size: Number of pooled connections. Control requests made with
+                   :meth:`get` share the pool with the frame requests.
+        timeout: Seconds the server may wait for a newer frame before a 304
+        flags: Flags for :func:`cv.imdecode`
+
+    """
+    # Seconds beyond :code:`timeout` to wait for the server before giving up
+    # on a request, so that a stalled connection can't hang the threads
+    timeout_margin = 5.
+
+    def __init__(self, host: str, port: int, params: Optional[Dict] = None,
+                 pool_size: int = 4, timeout: float = 1, flags: int = cv.IMREAD_COLOR):
+        self.server = f"http://{host}:{port}"
+        self.params = params or {}
+        self.timeout = timeout
+        self.flags = flags
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self._encoded = LatestFrame()
+        self._decoded = LatestFrame()
+        self._seq = None
+        self._last_read = 0
+        self._running = Event()
+        self._threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """Start the fetch and decode threads"""
+        self._running.set()
+        self._threads = [Thread(target=self._fetch_loop, daemon=True),
+                         Thread(target=self._decode_loop, daemon=True)]
+        for t in self._threads:
+            t.start()
+
+    def stop(self):
+        self._running.clear()
+        for t in self._threads:
+            t.join(self.timeout + self.timeout_margin)
+        self._threads = []
+        self.session.close()
+
+    def get(self, path: str, **params):
+        """Make a GET request for :code:`path` on the pooled session"""
+        return self.session.get(f"{self.server}{path}", params=params)
+
+    def fetch(self, after: Optional[int] = None):
+        """Fetch the encoded frame newer than sequence number :code:`after`
+
+        Returns:
+            A tuple of sequence number, capture timestamp and the encoded
+            data. The data is :code:`None` if there was no newer frame.
+
+        Raises:
+            ValueError: If the frame headers are missing or invalid
+
+        """
+        params = {**self.params, "timeout": self.timeout}
+        if after is not None:
+            params["after"] = after
+        resp = self.session.get(f"{self.server}/frame", params=params,
+                                timeout=self.timeout + self.timeout_margin)
+        if resp.status_code == 304:
+            return after, None, None
+        resp.raise_for_status()
+        try:
+            return (int(resp.headers["X-Frame-Seq"]),
+                    float(resp.headers["X-Frame-Timestamp"]), resp.content)
+        except (KeyError, ValueError) as e:
+            raise ValueError(f"Invalid frame headers: {e!r}")
+
+    def decode(self, data):
+        return cv.imdecode(np.frombuffer(data, dtype=np.uint8), flags=self.flags)
+
+    def _fetch_loop(self):
+        while self._running.is_set():
+            try:
+                seq, timestamp, data = self.fetch(self._seq)
+            except (requests.RequestException, ValueError) as e:
+                print(f"Error fetching frame: {e}")
+                self._running.wait(self.timeout)
+                continue
+            if data is not None:
+                self._seq = seq
+                self._encoded.publish((seq, timestamp, data))
+
+    def _decode_loop(self):
+        count = 0
+        while self._running.is_set():
+            newer, _, item = self._encoded.wait(count, timeout=self.timeout)
+            if item is None:
+                continue
+            count = newer
+            seq, timestamp, data = item
+            self._decoded.publish((seq, self.decode(data)), timestamp)
+
+    def read(self, timeout: Optional[float] = None):
+        """Return the newest decoded frame not returned before
+
+        If the fetch threads aren't running, the frame is fetched and decoded
+        synchronously.
+
+        Returns:
+            A tuple of sequence number, capture timestamp and the image. All
+            three are :code:`None` if no new frame arrived within :code:`timeout`.
+
+        """
+        if not self._running.is_set():
+            seq, timestamp, data = self.fetch(self._seq)
+            if data is None:
+                return None, None, None
+            self._seq = seq
+            return seq, timestamp, self.decode(data)
+        count, timestamp, item = self._decoded.wait(self._last_read, timeout)
+        if item is None:
+            return None, None, None
+        self._last_read = count
+        seq, img = item
+        return seq, timestamp, img
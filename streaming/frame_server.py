@@ -1,43 +1,70 @@
+import argparse
 import time
-from threading import Condition, Thread
-import base64
-import cv2 as cv
+from threading import Thread
 
 from picamera2 import Picamera2
 
-from flask import Flask, request
+from flask import Flask, Response, request
 from werkzeug import serving
 from common_pyutil.monitor import Timer
 
+from frame_cache import (EncodedFrameCache, LatestFrame, binary_frame, frame_request,
+                         parse_variant)
+from shm_ring import SharedFrameRing
+
 timer = Timer()
+boundary = "frame"
 
 
 class FrameServer:
-    def __init__(self, picam2, stream='main', port=8080):
+    def __init__(self, picam2, stream='main', port=8080, shm_name=None, shm_slots=4):
         """A simple class that can serve up frames from one of the Picamera2's configured
         streams to multiple other threads.
         Pass in the Picamera2 object and the name of the stream for which you want
-        to serve up frames."""
+        to serve up frames.
+        If shm_name is given, the frames are also published to a SharedFrameRing of
+        that name so that other processes on the board can read them without any
+        encoding or copying."""
         self._picam2 = picam2
         self._stream = stream
-        self._array = None
-        self._condition = Condition()
+        self._latest = LatestFrame()
+        self._condition = self._latest.condition
         self._running = True
-        self._count = 0
         self._thread = Thread(target=self._thread_func, daemon=True)
+        self._cache = EncodedFrameCache()
+        self._shm_name = shm_name
+        self._shm_slots = shm_slots
+        self._ring = None
         self.port = port
         self.app = Flask("Frame Server")
 
     @property
     def count(self):
         """A count of the number of frames received."""
-        return self._count
+        return self._latest.count
+
+    @property
+    def _array(self):
+        return self._latest.frame
 
     def start(self):
         """To start the FrameServer, you will also need to start the Picamera2 object."""
         self.init_routes()
         self._thread.start()
-        serving.run_simple("0.0.0.0", self.port, self.app)
+        serving.run_simple("0.0.0.0", self.port, self.app, threaded=True)
+
+    def start_async(self):
+        """Start the FrameServer with an asyncio server instead of werkzeug.
+
+        The frame waiters await an asyncio event instead of each blocking a
+        thread, so many concurrent clients don't exhaust the threads.
+
+        """
+        import async_server
+        app = async_server.web.Application()
+        async_server.add_frame_routes(app, self._latest, self._cache)
+        self._thread.start()
+        async_server.run(app, self.port)
 
     def stop(self):
         """To stop the FrameServer, first stop any client threads (that might be
@@ -45,14 +72,19 @@ class FrameServer:
         Picamera2 object until the FrameServer has been stopped."""
         self._running = False
         self._thread.join()
+        if self._ring is not None:
+            self._ring.close()
 
     def _thread_func(self):
         while self._running:
             array = self._picam2.capture_array(self._stream)
-            self._count += 1
-            with self._condition:
-                self._array = array
-                self._condition.notify_all()
+            timestamp = time.time()
+            if self._shm_name:
+                if self._ring is None:
+                    self._ring = SharedFrameRing.create(self._shm_name, array.shape,
+                                                        array.dtype, self._shm_slots)
+                self._ring.write(array, timestamp)
+            self._latest.publish(array, timestamp)
 
     def wait_for_frame(self, previous=None):
         """You may optionally pass in the previous frame that you got last time you
@@ -70,18 +102,72 @@ class FrameServer:
     def init_routes(self):
         @self.app.route("/get_frame", methods=["GET"])
         def __get_frame():
+            try:
+                variant = parse_variant(request.args)
+            except ValueError as e:
+                return str(e), 400
             with timer:
-                frame = self.wait_for_frame()
+                count, timestamp, frame = self._latest.wait()
             print(timer.time)
             with timer:
-                status, buf = cv.imencode(".jpg", frame)
+                data = self._cache.b64(count, frame, variant)
             print(timer.time)
-            data = base64.b64encode(buf)
             return data
 
+        @self.app.route("/frame", methods=["GET"])
+        def __frame():
+            try:
+                after, timeout = frame_request(request.args, request.headers)
+            except ValueError as e:
+                return str(e), 400
+            count, timestamp, frame = self._latest.wait(after, timeout)
+            if frame is None:
+                return Response(status=304)
+            try:
+                data, mimetype, headers = binary_frame(self._cache, count, timestamp, frame,
+                                                       request.args.get("format", "jpg"),
+                                                       parse_variant(request.args))
+            except ValueError as e:
+                return str(e), 400
+            return Response(data, mimetype=mimetype, headers=headers)
+
+        @self.app.route("/stream", methods=["GET"])
+        def __stream():
+            try:
+                variant = parse_variant(request.args)
+            except ValueError as e:
+                return str(e), 400
+            return Response(self.mjpeg_stream(variant),
+                            mimetype=f"multipart/x-mixed-replace; boundary={boundary}")
+
+    def mjpeg_stream(self, variant=None):
+        """Generate a :code:`multipart/x-mixed-replace` stream of JPEG frames.
+
+        Each new frame is pushed to the client as soon as it is captured, so
+        the client doesn't pay a request round trip per frame.
+
+        Args:
+            variant: Optional :class:`frame_cache.Variant` of the frames
+
+        """
+        count = None
+        while self._running:
+            count, timestamp, frame = self._latest.wait(count)
+            buf = self._cache.jpeg(count, frame, variant)
+            yield (f"--{boundary}\r\nContent-Type: image/jpeg\r\n"
+                   f"Content-Length: {len(buf)}\r\n\r\n").encode() + buf + b"\r\n"
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("--asyncio", action="store_true", help="Use the asyncio server")
+    parser.add_argument("--shm", help="Also publish frames to a shared memory ring of this name")
+    args = parser.parse_args()
     cam = Picamera2()
-    server = FrameServer(cam)
+    server = FrameServer(cam, port=args.port, shm_name=args.shm)
     cam.start()
-    server.start()
+    if args.asyncio:
+        server.start_async()
+    else:
+        server.start()
@@ -1,23 +1,70 @@
 import argparse
-import base64
 
 import requests
-import numpy as np
 import cv2 as cv
 from common_pyutil.monitor import Timer
 
+from frame_client import FrameClient
+
 
 timer = Timer()
 
 
-def show_live(host, port, flip=0, convert=None):
+def iter_mjpeg(url, chunk_size=16384):
+    """Iterate over JPEG frames pushed by a :code:`multipart/x-mixed-replace` endpoint
+
+    Each part is expected to carry a :code:`Content-Length` header, as sent by
+    :meth:`frame_server.FrameServer.mjpeg_stream`.
+
+    Args:
+        url: URL of the stream endpoint
+        chunk_size: Size of chunks read from the socket
+
+    Yields:
+        Encoded JPEG bytes of each frame
+
+    """
+    with requests.get(url, stream=True) as resp:
+        buf = b""
+        length = None
+        for chunk in resp.iter_content(chunk_size=chunk_size):
+            buf += chunk
+            while True:
+                if length is None:
+                    header_end = buf.find(b"\r\n\r\n")
+                    if header_end == -1:
+                        break
+                    for line in buf[:header_end].split(b"\r\n"):
+                        if line.lower().startswith(b"content-length:"):
+                            length = int(line.split(b":", 1)[1])
+                    buf = buf[header_end + 4:]
+                    if length is None:
+                        continue
+                if len(buf) < length:
+                    break
+                yield buf[:length]
+                buf = buf[length:]
+                length = None
+
+
+def show_live(host, port, flip=0, convert=None, stream=False):
     server = f"http://{host}:{port}"
+    frames = iter_mjpeg(f"{server}/stream") if stream else None
+    client = FrameClient(host, port)
+    if not stream:
+        client.start()
     while True:
         with timer:
-            resp = requests.get(f"{server}/get_frame")
+            if stream:
+                img = client.decode(next(frames))
+            else:
+                seq, timestamp, img = client.read(timeout=1)
         print(timer.time)
-        img = cv.imdecode(np.frombuffer(base64.b64decode(resp.content), dtype=np.uint8),
-                          flags=cv.IMREAD_COLOR)
+        if img is None:
+            # Still let the viewer be closed while no frames arrive
+            if cv.waitKey(1) == ord('q'):
+                break
+            continue
         if convert:
             img = img[:, :, ::-1]
         i = 0
@@ -31,6 +78,8 @@ def show_live(host, port, flip=0, convert=None):
         except KeyboardInterrupt:
             cv.destroyAllWindows()
     cv.destroyAllWindows()
+    if not stream:
+        client.stop()
 
 
 if __name__ == '__main__':
@@ -38,5 +87,7 @@ if __name__ == '__main__':
     parser.add_argument("host")
     parser.add_argument("-p", "--port", type=int, default=8080)
     parser.add_argument("--no-bgr2rgb", dest="bgr2rgb", action="store_false")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read frames from the MJPEG push stream instead of polling")
     args = parser.parse_args()
-    show_live(args.host, args.port, convert=args.bgr2rgb)
+    show_live(args.host, args.port, convert=args.bgr2rgb, stream=args.stream)
@@ -0,0 +1,150 @@
+from collections import OrderedDict
+from threading import Condition, Thread
+import re
+
+from flask import Flask, Response, request
+from werkzeug import serving
+
+
+mimetypes = {"m3u8": "application/vnd.apple.mpegurl",
+             "ts": "video/mp2t",
+             "m4s": "video/iso.segment",
+             "mp4": "video/mp4"}
+
+
+class SegmentStore:
+    """A bounded in-memory store for HLS playlists and segments
+
+    The oldest segments are evicted once there are more than
+    :code:`max_segments` of them. Playlists are kept separately and are never
+    evicted.
+
+    Args:
+        max_segments: Maximum number of segments to keep
+
+    """
+    def __init__(self, max_segments: int = 8):
+        self.max_segments = max_segments
+        self.media_sequence = -1
+        self._segments: OrderedDict = OrderedDict()
+        self._playlists = {}
+        self._condition = Condition()
+
+    def put(self, name: str, data: bytes):
+        with self._condition:
+            if name.endswith(".m3u8"):
+                self._playlists[name] = self._server_control(data)
+                self.media_sequence = max(self.media_sequence, self._last_sequence(data))
+            else:
+                self._segments[name] = data
+                self._segments.move_to_end(name)
+                while len(self._segments) > self.max_segments:
+                    self._segments.popitem(last=False)
+            self._condition.notify_all()
+
+    def get(self, name: str):
+        with self._condition:
+            if name.endswith(".m3u8"):
+                return self._playlists.get(name)
+            return self._segments.get(name)
+
+    def delete(self, name: str):
+        with self._condition:
+            self._playlists.pop(name, None)
+            self._segments.pop(name, None)
+
+    def wait_for_sequence(self, msn: int, timeout: float):
+        """Wait until the playlist contains media sequence number :code:`msn`"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self.media_sequence >= msn, timeout)
+
+    @staticmethod
+    def _server_control(playlist: bytes):
+        """Advertise blocking reload, so that the players send :code:`_HLS_msn`"""
+        if b"#EXT-X-SERVER-CONTROL" in playlist or not playlist.startswith(b"#EXTM3U"):
+            return playlist
+        header, _, rest = playlist.partition(b"\n")
+        return header + b"\n#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES\n" + rest
+
+    @staticmethod
+    def _last_sequence(playlist: bytes):
+        text = playlist.decode(errors="ignore")
+        match = re.search(r"#EXT-X-MEDIA-SEQUENCE:(\d+)", text)
+        first = int(match.group(1)) if match else 0
+        return first + text.count("#EXTINF") - 1
+
+
+class HLSServer:
+    """Serve HLS from memory instead of from files on the SD card.
+
+    :code:`ffmpeg` uploads the playlist and segments with HTTP :code:`PUT` to
+    this server (see :meth:`ffmpeg_output`) and the players fetch them with
+    :code:`GET`, so nothing is ever written to the disk.
+
+    Playlist requests support blocking reload as in Low-Latency HLS: with
+    :code:`?_HLS_msn=N` the response is held until the segment with media
+    sequence number N is available, so that a player gets a new segment as soon
+    as it's ready rather than on its next poll. The playlists are served with
+    :code:`#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES` so that the players
+    know to ask for it.
+
+    Args:
+        port: HTTP port to listen on
+        segment_duration: Target segment duration in seconds. Sub-second
+                          durations need a keyframe at least as often.
+        list_size: Number of segments in the playlist
+        prefix: URL prefix for the playlist and segments
+
+    """
+    def __init__(self, port: int = 8080, segment_duration: float = 1.0,
+                 list_size: int = 5, prefix: str = "hls"):
+        self.port = port
+        self.segment_duration = segment_duration
+        self.list_size = list_size
+        self.prefix = prefix
+        self.store = SegmentStore(max_segments=list_size + 3)
+        self.app = Flask("HLS Server")
+        self._thread = Thread(target=self._serve, daemon=True)
+        self.init_routes()
+
+    def ffmpeg_output(self, playlist: str = "stream.m3u8"):
+        """Output options for :code:`ffmpeg` to upload the stream to this server"""
+        return (f"-f hls -hls_time {self.segment_duration} -hls_list_size {self.list_size} "
+                "-hls_flags delete_segments+omit_endlist+program_date_time -hls_allow_cache 0 "
+                "-method PUT -http_persistent 0 "
+                f"http://127.0.0.1:{self.port}/{self.prefix}/{playlist}")
+
+    def start(self):
+        self._thread.start()
+
+    def _serve(self):
+        serving.run_simple("0.0.0.0", self.port, self.app, threaded=True)
+
+    def init_routes(self):
+        @self.app.route(f"/{self.prefix}/<name>", methods=["PUT", "POST"])
+        def _upload(name):
+            if request.remote_addr not in {"127.0.0.1", "::1"}:
+                return "Forbidden", 403
+            self.store.put(name, request.get_data())
+            return ""
+
+        @self.app.route(f"/{self.prefix}/<name>", methods=["DELETE"])
+        def _delete(name):
+            if request.remote_addr not in {"127.0.0.1", "::1"}:
+                return "Forbidden", 403
+            self.store.delete(name)
+            return ""
+
+        @self.app.route(f"/{self.prefix}/<name>", methods=["GET"])
+        def _get(name):
+            if name.endswith(".m3u8") and "_HLS_msn" in request.args:
+                try:
+                    msn = int(request.args.get("_HLS_msn"))
+                except ValueError:
+                    return "Invalid _HLS_msn", 400
+                self.store.wait_for_sequence(msn, timeout=3 * self.segment_duration + 1)
+            data = self.store.get(name)
+            if data is None:
+                return "Not found", 404
+            return Response(data, mimetype=mimetypes.get(name.rsplit(".", 1)[-1]),
+                            headers={"Cache-Control": "no-cache"})
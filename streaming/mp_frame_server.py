@@ -0,0 +1,332 @@
+from typing import Optional
+import argparse
+import multiprocessing
+import signal
+import socket
+import time
+
+import numpy as np
+from werkzeug import serving
+
+from frame_cache import EncodedFrameCache, encode_jpeg, fit_variant
+from frame_server import FrameServer
+from shm_ring import SharedFrameRing
+
+
+def _attach(name: str, running=lambda: True):
+    while running():
+        try:
+            return SharedFrameRing.attach(name)
+        except FileNotFoundError:
+            # The ring is created with the first frame
+            time.sleep(.1)
+
+
+class SharedJpegRing:
+    """JPEG encoded frames in a :class:`SharedFrameRing` of byte rows
+
+    Each row starts with the length of the JPEG and the sequence number of the
+    frame of the frame ring it was encoded from, followed by the JPEG bytes.
+
+    Args:
+        ring: The ring of rows, from :meth:`create` or :meth:`attach`
+
+    """
+    header = 2
+
+    def __init__(self, ring: SharedFrameRing):
+        self.ring = ring
+        self.capacity = ring.shape[1] - self.header * 8
+        self._row = np.zeros(ring.shape, dtype=np.uint8)
+
+    @classmethod
+    def create(cls, name: str, capacity: int, slots: int = 4):
+        return cls(SharedFrameRing.create(name, (1, cls.header * 8 + capacity), np.uint8, slots))
+
+    @classmethod
+    def attach(cls, name: str, running=lambda: True):
+        ring = _attach(name, running)
+        return None if ring is None else cls(ring)
+
+    def write(self, frame_seq: int, data: bytes, timestamp: float) -> bool:
+        """Write the JPEG of frame :code:`frame_seq`. Returns :code:`False` if it doesn't fit."""
+        if len(data) > self.capacity:
+            return False
+        self._row[0, :self.header * 8].view(np.int64)[:] = len(data), frame_seq
+        self._row[0, self.header * 8:self.header * 8 + len(data)] = np.frombuffer(data, np.uint8)
+        self.ring.write(self._row, timestamp)
+        return True
+
+    def wait(self, after: Optional[int] = None, timeout: Optional[float] = None):
+        """Wait for a JPEG newer than :code:`after`
+
+        Returns:
+            A tuple of the sequence number in this ring, the sequence number of
+            the frame, the capture timestamp and a copy of the JPEG bytes.
+            All four are :code:`None` if there's no newer JPEG.
+
+        """
+        seq, timestamp, row = self.ring.wait(after, timeout)
+        if row is None:
+            return None, None, None, None
+        length, frame_seq = (int(x) for x in row[0, :self.header * 8].view(np.int64))
+        data = row[0, self.header * 8:self.header * 8 + length].tobytes()
+        if not self.ring.is_valid(seq):
+            return None, None, None, None
+        return seq, frame_seq, timestamp, data
+
+    def find(self, frame_seq: int):
+        """Look up the JPEG of frame :code:`frame_seq` without waiting
+
+        Returns:
+            A tuple of a copy of the JPEG bytes, :code:`None` if it's not in
+            the ring, and the newest frame sequence number in the ring.
+
+        """
+        newest = 0
+        latest = self.ring.latest_seq
+        for seq in range(latest, max(0, latest - self.ring.slots), -1):
+            row = self.ring.read_seq(seq)[1]
+            if row is None:
+                continue
+            length, row_frame_seq = (int(x) for x in row[0, :self.header * 8].view(np.int64))
+            newest = max(newest, row_frame_seq)
+            if row_frame_seq == frame_seq:
+                data = row[0, self.header * 8:self.header * 8 + length].tobytes()
+                if self.ring.is_valid(seq):
+                    return data, newest
+        return None, newest
+
+    def close(self):
+        self.ring.close()
+
+
+class SharedJpegCache(EncodedFrameCache):
+    """An :class:`frame_cache.EncodedFrameCache` which gets the full size JPEGs from :code:`lookup`
+
+    Args:
+        lookup: Callable of the sequence number and the frame returning the JPEG
+        maxsize: Maximum number of encoded entries to keep
+
+    """
+    def __init__(self, lookup, maxsize: int = 32):
+        super().__init__(maxsize)
+        self._lookup = lookup
+
+    def jpeg(self, seq, frame, variant=None):
+        if fit_variant(variant, frame.shape) is not None:
+            return super().jpeg(seq, frame, variant)
+        return self.get((seq, "jpg", None), lambda: self._lookup(seq, frame))
+
+
+class RingFrameServer(FrameServer):
+    """A :class:`FrameServer` worker which serves the frames of a :class:`SharedFrameRing`
+
+    Instead of capturing, the frame thread copies each new frame from the
+    ring of the capture process and publishes it with the sequence number of
+    the ring, so that :code:`X-Frame-Seq`, :code:`after` and the ETags are
+    the same whichever worker serves a request. The HTTP server accepts on a
+    listening socket shared by all the workers.
+
+    The full size JPEG of each frame is encoded once by one of the
+    :code:`encoders` encoder processes (:func:`encode_loop`), each into its
+    own :class:`SharedJpegRing`. Frames are published as soon as they're
+    captured, so the raw frames and the other variants don't wait for the
+    JPEG. A request for the full size JPEG waits up to
+    :code:`jpeg_wait` seconds for it in the ring of its encoder and encodes
+    it in the worker if it doesn't arrive, e.g. when the encoders fall behind.
+
+    Args:
+        shm_name: Name of the ring of the capture process
+        fd: File descriptor of the shared listening socket
+        port: Port of the listening socket
+        encoders: Number of encoder processes
+        jpeg_wait: Seconds to wait for the JPEG from the encoders
+
+    """
+    def __init__(self, shm_name: str, fd: int, port: int = 8080, encoders: int = 1,
+                 jpeg_wait: float = .2):
+        super().__init__(None, port=port)
+        self._ring_name = shm_name
+        self._fd = fd
+        self._encoders = encoders
+        self._jpeg_wait = jpeg_wait
+        self._jpegs = []
+        self._cache = SharedJpegCache(self._shared_jpeg)
+
+    def _shared_jpeg(self, seq, frame):
+        if len(self._jpegs) == self._encoders:
+            jpegs = self._jpegs[seq % self._encoders]
+            deadline = time.time() + self._jpeg_wait
+            while True:
+                data, newest = jpegs.find(seq)
+                if data is not None:
+                    return data
+                # The encoder skipped it or is too slow
+                if newest >= seq or time.time() > deadline:
+                    break
+                time.sleep(.001)
+        return encode_jpeg(frame)
+
+    def _thread_func(self):
+        running = lambda: self._running  # noqa: E731
+        self._ring = _attach(self._ring_name, running)
+        for i in range(self._encoders):
+            jpegs = SharedJpegRing.attach(f"{self._ring_name}_jpg{i}", running)
+            if jpegs is None:
+                return
+            self._jpegs.append(jpegs)
+        seq = 0
+        while self._running:
+            newer, timestamp, frame = self._ring.wait(seq, timeout=1)
+            if frame is None:
+                continue
+            # The slot is reused after slots - 1 frames, while encoding and
+            # sending may take longer than that
+            frame = frame.copy()
+            if self._ring.is_valid(newer):
+                seq = newer
+                self._latest.publish(frame, timestamp, count=seq)
+
+    def start(self):
+        self.init_routes()
+        self._thread.start()
+        server = serving.make_server("0.0.0.0", self.port, self.app, threaded=True, fd=self._fd)
+        server.serve_forever()
+
+
+def capture_loop(shm_name: str, stream: str, slots: int, stop):
+    """Capture frames with :class:`picamera2.Picamera2` into a new :class:`SharedFrameRing`
+
+    Runs in the capture process until :code:`stop` is set.
+
+    """
+    from picamera2 import Picamera2
+
+    cam = Picamera2()
+    cam.start()
+    ring = None
+    try:
+        while not stop.is_set():
+            array = cam.capture_array(stream)
+            if ring is None:
+                ring = SharedFrameRing.create(shm_name, array.shape, array.dtype, slots)
+            ring.write(array, time.time())
+    finally:
+        cam.stop()
+        if ring is not None:
+            ring.close()
+
+
+def encode_loop(shm_name: str, index: int, encoders: int, stop, slots: int = 2):
+    """Encode the frames of the :class:`SharedFrameRing` into a :class:`SharedJpegRing`
+
+    Runs in encoder process :code:`index` of :code:`encoders` until
+    :code:`stop` is set. Each encoder takes the frames whose sequence number
+    modulo :code:`encoders` is its :code:`index`, the newest of them first,
+    so the encoding is spread over the processes and frames of its share
+    which arrive while encoding are skipped.
+
+    """
+    frames = _attach(shm_name, lambda: not stop.is_set())
+    if frames is None:
+        return
+    # A JPEG is smaller than the raw frame
+    jpegs = SharedJpegRing.create(f"{shm_name}_jpg{index}",
+                                  int(np.prod(frames.shape)) * frames.dtype.itemsize, slots)
+    last = 0
+    try:
+        while not stop.is_set():
+            latest = frames.latest_seq
+            seq = latest - (latest - index) % encoders
+            if seq <= last:
+                time.sleep(.0005)
+                continue
+            last = seq
+            timestamp, frame = frames.read_seq(seq)
+            if frame is None:
+                continue
+            data = encode_jpeg(frame)
+            if frames.is_valid(seq):
+                jpegs.write(seq, data, timestamp)
+    finally:
+        jpegs.close()
+        frames.close()
+
+
+def serve_worker(shm_name: str, fd: int, port: int, encoders: int):
+    RingFrameServer(shm_name, fd, port, encoders).start()
+
+
+def serve(port: int = 8080, workers: int = 4, shm_name: str = "frame_server",
+          stream: str = "main", slots: int = 8, encoders: Optional[int] = None):
+    """Serve the camera with a capture process and a pool of serving processes
+
+    The capture process writes the frames to a :class:`SharedFrameRing`, the
+    :code:`encoders` encoder processes share the encoding of each of them
+    once to JPEG and each of the :code:`workers` processes runs a
+    :class:`RingFrameServer` accepting on the same listening socket. The full
+    size JPEGs are shared by all the workers and the encoding of the other
+    variants, the base64 and the sending is spread over the cores instead of
+    sharing one GIL.
+
+    Args:
+        port: HTTP port
+        workers: Number of serving processes
+        shm_name: Name of the shared memory ring
+        stream: Camera stream to capture
+        slots: Number of slots in the ring
+        encoders: Number of encoder processes, :code:`workers` if not given
+
+    """
+    encoders = encoders or workers
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+    # fork so that the workers inherit the listening socket. Nothing else has
+    # been started in this process yet.
+    ctx = multiprocessing.get_context("fork")
+    stop = ctx.Event()
+    capture = ctx.Process(target=capture_loop, args=(shm_name, stream, slots, stop),
+                          name="capture")
+    encoder_procs = [ctx.Process(target=encode_loop, args=(shm_name, i, encoders, stop),
+                                 name=f"encoder-{i}")
+                     for i in range(encoders)]
+    servers = [ctx.Process(target=serve_worker, args=(shm_name, sock.fileno(), port, encoders),
+                           name=f"worker-{i}", daemon=True)
+               for i in range(workers)]
+    capture.start()
+    for p in encoder_procs:
+        p.start()
+    for p in servers:
+        p.start()
+    # Stop the capture process, which unlinks the ring, on SIGTERM too
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    print(f"Serving on port {port} with {workers} workers")
+    try:
+        capture.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        capture.join(5)
+        for p in encoder_procs:
+            p.join(5)
+        for p in servers:
+            p.terminate()
+            p.join()
+        sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("-j", "--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--shm", default="frame_server", help="Name of the shared memory ring")
+    parser.add_argument("--slots", type=int, default=8)
+    parser.add_argument("--encoders", type=int,
+                        help="Number of JPEG encoder processes, the number of workers by default")
+    args = parser.parse_args()
+    serve(args.port, args.workers, args.shm, slots=args.slots, encoders=args.encoders)
@@ -0,0 +1,207 @@
+from typing import Optional, Tuple
+from multiprocessing import shared_memory
+import time
+
+import numpy as np
+
+
+MAGIC = 0x46524d52  # "FRMR"
+HEADER_FIELDS = 8
+ALIGN = 64
+
+
+class SharedFrameRing:
+    """A ring of fixed size frame slots in shared memory.
+
+    One writer process (the camera) publishes frames into the slots and any
+    number of reader processes on the same machine get NumPy views of them,
+    without encoding or copying.
+
+    The shared memory starts with an :code:`int64` header:
+
+    - magic, number of slots, height, width, channels, dtype char, latest
+      sequence number and a reserved field
+    - the sequence number of each slot, negative while it's being written
+    - the capture timestamp of each slot in nanoseconds
+
+    followed by the frame slots.
+
+    A view returned by :meth:`read_latest`, :meth:`read_seq` or :meth:`wait`
+    is valid only until the writer wraps around to its slot again, that is for
+    :code:`slots - 1` more frames. Readers which may be slower than that should
+    check :meth:`is_valid` after using it or copy the frame. :meth:`read`
+    returns such a checked copy.
+
+    Use :meth:`create` in the writer and :meth:`attach` in the readers.
+
+    """
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+        self.shm = shm
+        self.owner = owner
+        # np.frombuffer holds on to the buffer, so that the memory stays mapped
+        # as long as any view of it exists (see :meth:`close`)
+        self._header = np.frombuffer(shm.buf, dtype=np.int64, count=HEADER_FIELDS)
+        if self._header[0] != MAGIC:
+            raise ValueError(f"{shm.name} is not a frame ring")
+        self.slots = int(self._header[1])
+        self.shape = tuple(int(x) for x in self._header[2:5] if x)
+        self.dtype = np.dtype(chr(int(self._header[5])))
+        self._seqs = np.frombuffer(shm.buf, dtype=np.int64, count=self.slots,
+                                   offset=HEADER_FIELDS * 8)
+        self._timestamps = np.frombuffer(shm.buf, dtype=np.int64, count=self.slots,
+                                         offset=(HEADER_FIELDS + self.slots) * 8)
+        offset = self._data_offset(self.slots)
+        self._frames = np.frombuffer(shm.buf, dtype=self.dtype,
+                                     count=self.slots * int(np.prod(self.shape)),
+                                     offset=offset).reshape(self.slots, *self.shape)
+        self._last_read = 0
+
+    @staticmethod
+    def _data_offset(slots):
+        offset = (HEADER_FIELDS + 2 * slots) * 8
+        return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+    @classmethod
+    def create(cls, name: str, shape: Tuple[int, ...], dtype=np.uint8, slots: int = 4):
+        """Create the ring. Called by the writer.
+
+        A block of the same name left behind by a writer which crashed is
+        unlinked and created again.
+
+        Args:
+            name: Name of the shared memory block
+            shape: Shape of the frames
+            dtype: dtype of the frames
+            slots: Number of frame slots
+
+        """
+        dtype = np.dtype(dtype)
+        if len(shape) not in {2, 3}:
+            raise ValueError(f"Frames must be 2 or 3 dimensional, not {shape}")
+        size = cls._data_offset(slots) + slots * int(np.prod(shape)) * dtype.itemsize
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            print(f"Shared memory {name} exists, probably from a crashed run. Recreating it.")
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        header[:] = [MAGIC, slots, *shape, *([0] * (3 - len(shape))), ord(dtype.char), 0, 0]
+        np.ndarray((2 * slots,), dtype=np.int64, buffer=shm.buf, offset=HEADER_FIELDS * 8)[:] = 0
+        del header
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str):
+        """Attach to an existing ring. Called by the readers."""
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13 registers the block with the resource tracker of
+            # the reader, which would unlink it when the reader exits
+            from multiprocessing import resource_tracker
+            shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm, owner=False)
+
+    @property
+    def latest_seq(self) -> int:
+        return int(self._header[6])
+
+    def write(self, frame: np.ndarray, timestamp: Optional[float] = None):
+        """Copy a frame into the next slot and publish it. Returns its sequence number."""
+        seq = self.latest_seq + 1
+        slot = seq % self.slots
+        self._seqs[slot] = -seq
+        np.copyto(self._frames[slot], frame.reshape(self.shape))
+        self._timestamps[slot] = int((timestamp or time.time()) * 1e9)
+        self._seqs[slot] = seq
+        self._header[6] = seq
+        return seq
+
+    def is_valid(self, seq: int) -> bool:
+        """Whether the slot of frame :code:`seq` still holds that frame"""
+        return int(self._seqs[seq % self.slots]) == seq
+
+    def read_seq(self, seq: int):
+        """Return the capture timestamp and a view of frame :code:`seq` if it's still in the ring
+
+        Both are :code:`None` if the slot has been reused.
+
+        """
+        slot = seq % self.slots
+        timestamp = int(self._timestamps[slot]) / 1e9
+        if not self.is_valid(seq):
+            return None, None
+        return timestamp, self._frames[slot]
+
+    def read_latest(self, after: Optional[int] = None):
+        """Return the latest frame if it's newer than :code:`after` without waiting
+
+        Returns:
+            A tuple of sequence number, capture timestamp and a view of the
+            frame. All three are :code:`None` if there's no newer frame.
+
+        """
+        seq = self.latest_seq
+        if seq == 0 or (after is not None and seq <= after):
+            return None, None, None
+        slot = seq % self.slots
+        timestamp = int(self._timestamps[slot]) / 1e9
+        if not self.is_valid(seq):
+            return None, None, None
+        return seq, timestamp, self._frames[slot]
+
+    def wait(self, after: Optional[int] = None, timeout: Optional[float] = None,
+             poll: float = .0005):
+        """Wait for a frame newer than :code:`after`. See :meth:`read_latest`"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            seq, timestamp, frame = self.read_latest(after)
+            if frame is not None:
+                return seq, timestamp, frame
+            if deadline is not None and time.time() > deadline:
+                return None, None, None
+            time.sleep(poll)
+
+    def read(self):
+        """Wait for the next frame, like :meth:`cv2.VideoCapture.read`
+
+        The frame is a copy, checked to be complete with :meth:`is_valid`, so
+        it can be kept after the slot is reused or the ring is closed.
+
+        """
+        deadline = time.time() + 1
+        while True:
+            seq, timestamp, frame = self.wait(self._last_read,
+                                              timeout=max(0, deadline - time.time()))
+            if frame is None:
+                return False, None
+            frame = frame.copy()
+            if self.is_valid(seq):
+                self._last_read = seq
+                return True, frame
+
+    def release(self):
+        self.close()
+
+    def close(self):
+        """Close the ring, and remove it if it was created here
+
+        It's safe to call while views of the frames are still in use. The
+        memory then stays mapped until the last of them is garbage collected.
+
+        """
+        if self._frames is None:
+            return
+        self._header = self._seqs = self._timestamps = self._frames = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # Views still exist. The mapping is closed with the SharedMemory
+            # object once they're gone.
+            pass
+        if self.owner:
+            self.shm.unlink()
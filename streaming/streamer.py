@@ -1,14 +1,16 @@
 import argparse
-import socket
 import time
 
 from picamera2 import Picamera2
 from picamera2.encoders import H264Encoder
-from picamera2.outputs import FileOutput, FfmpegOutput
+from picamera2.outputs import FfmpegOutput
+
+from broadcaster import H264Broadcaster
+from hls_server import HLSServer
 
 
 class Streamer:
-    def __init__(self, hostname, port, bit_rate, size, http=False):
+    def __init__(self, hostname, port, bit_rate, size, http=False, frame_rate=25):
         self.hostname = hostname
         self.port = port
         self.cam = Picamera2()
@@ -16,25 +18,25 @@ class Streamer:
         self.cam.configure(video_config)
         self.size = size
         self.bit_rate = bit_rate
-        self.encoder = H264Encoder(bit_rate)
+        self.frame_rate = frame_rate
+        # Repeat SPS/PPS with a keyframe every second so that the TCP
+        # subscribers joining late can start decoding quickly
+        self.encoder = H264Encoder(bit_rate, repeat=True, iperiod=frame_rate)
         self.http = http
 
     def start_tcp(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind((self.hostname, self.port))
-        self.sock.listen()
-        self.cam.encoder = self.encoder
-        self.conn, self.addr = self.sock.accept()
-        self.stream = self.conn.makefile("wb")
-        self.cam.encoder.output = FileOutput(self.stream)
-        self.cam.start_encoder()
-        self.cam.start()
+        """Start streaming H.264 over TCP.
+
+        Any number of clients can connect. The encoder output is fanned out to
+        all of them by :class:`H264Broadcaster`.
+
+        """
+        self.broadcaster = H264Broadcaster(self.hostname, self.port)
+        self.cam.start_recording(self.encoder, self.broadcaster)
 
     def stop_tcp(self):
-        self.cam.stop()
-        self.conn.close()
-        self.sock.close()
+        self.cam.stop_recording()
+        self.broadcaster.close()
 
     def stop_ffmpeg(self):
         self.cam.stop()
@@ -44,14 +46,40 @@ class Streamer:
                               "-hls_allow_cache 0 stream.m3u8")
         self.cam.start_recording(self.encoder, output)
 
+    def start_hls(self, segment_duration=1.0, list_size=5):
+        """Stream HLS from memory.
+
+        Unlike :meth:`start_ffmpeg`, the playlist and the segments are
+        uploaded by :code:`ffmpeg` to an in-process :class:`HLSServer` and
+        served from there at :code:`/hls/stream.m3u8` on :attr:`port`. A
+        keyframe is forced at every segment boundary so that the segments can
+        be shorter than a second.
+
+        Args:
+            segment_duration: Target segment duration in seconds
+            list_size: Number of segments in the playlist
+
+        """
+        self.hls = HLSServer(self.port, segment_duration, list_size)
+        self.hls.start()
+        self.encoder = H264Encoder(self.bit_rate, repeat=True,
+                                   iperiod=max(1, round(self.frame_rate * segment_duration)))
+        output = FfmpegOutput(f"-r {self.frame_rate} " + self.hls.ffmpeg_output())
+        self.cam.start_recording(self.encoder, output)
+
+    def stop_hls(self):
+        self.cam.stop_recording()
+
 
-def main(method, port, frame_rate, bit_rate, size):
-    service = Streamer("0.0.0.0", port)
+def main(method, port, frame_rate, bit_rate, size, segment_duration):
+    service = Streamer("0.0.0.0", port, bit_rate, size, frame_rate=frame_rate)
     try:
         if method == "ffmpeg":
             service.start_ffmpeg()
         elif method == "tcp":
             service.start_tcp()
+        elif method == "hls":
+            service.start_hls(segment_duration)
         else:
             raise ValueError(f"Unknown method {method}")
         while True:
@@ -61,6 +89,8 @@ def main(method, port, frame_rate, bit_rate, size):
             service.stop_ffmpeg()
         elif method == "tcp":
             service.stop_tcp()
+        elif method == "hls":
+            service.stop_hls()
 
 
 if __name__ == '__main__':
@@ -70,6 +100,8 @@ if __name__ == '__main__':
     parser.add_argument("-f", "--frame-rate", type=int, default=25)
     parser.add_argument("-b", "--bit-rate", type=int, default=500000)
     parser.add_argument("-s", "--size", default="1280,720")
+    parser.add_argument("--segment-duration", type=float, default=1.0,
+                        help="HLS segment duration in seconds for the \"hls\" method")
     args = parser.parse_args()
     size = [*map(int, args.size.split(","))]
-    main(args.method, args.port, args.frame_rate, args.bit_rate, size)
+    main(args.method, args.port, args.frame_rate, args.bit_rate, size, args.segment_duration)
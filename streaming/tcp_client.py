@@ -1,70 +1,319 @@
-from queue import Queue
-from threading import Event
+from typing import List, Optional
+from queue import Queue, Full, Empty
+from threading import Condition, Event
 from threading import Thread
+from functools import lru_cache
+import re
 import socket
 import argparse
-import io
-from io import BytesIO
-
+import subprocess
 
+import numpy as np
 import cv2 as cv
 
+from frame_cache import LatestFrame
+
+
+START_CODE = b"\x00\x00\x00\x01"
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SPS = 7
+NAL_PPS = 8
+
+
+class ByteRing:
+    """A bounded byte buffer between the socket reader and the NAL parser.
+
+    When the writer gets ahead of the reader by more than :code:`capacity`
+    bytes, the oldest bytes are discarded and :attr:`overflowed` is set so that
+    the reader can resynchronize at the next keyframe instead of feeding a
+    corrupt stream to the decoder.
+
+    Args:
+        capacity: Maximum number of bytes held
+
+    """
+    def __init__(self, capacity: int = 1024 * 1024):
+        self.capacity = capacity
+        self.overflowed = False
+        self.closed = False
+        self._buf = bytearray()
+        self._condition = Condition()
+
+    def write(self, data: bytes):
+        with self._condition:
+            self._buf += data
+            if len(self._buf) > self.capacity:
+                del self._buf[:len(self._buf) - self.capacity]
+                self.overflowed = True
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def read(self, timeout: Optional[float] = None):
+        """Take all the bytes available, waiting up to :code:`timeout` for any
+
+        Returns:
+            A tuple of the bytes and whether the buffer had overflowed since
+            the last read.
+
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._buf or self.closed, timeout)
+            data = bytes(self._buf)
+            self._buf.clear()
+            overflowed, self.overflowed = self.overflowed, False
+            return data, overflowed
+
+
+class NALParser:
+    """Incrementally split an H.264 Annex B byte stream into NAL units.
+
+    A NAL unit is emitted only when the start code of the next one has been
+    seen, so partial units are held back until the rest of them arrives.
+
+    Args:
+        max_nal_size: Pending bytes without a start code beyond which the
+                      buffer is discarded
+
+    """
+    def __init__(self, max_nal_size: int = 1024 * 1024):
+        self.max_nal_size = max_nal_size
+        self._buf = bytearray()
+
+    def reset(self):
+        self._buf.clear()
+
+    def flush(self) -> List[bytes]:
+        """Return the last pending NAL unit at the end of the stream"""
+        return self.feed(b"\x00\x00\x01")
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """Feed bytes to the parser and return the completed NAL units without start codes"""
+        self._buf += data
+        nals = []
+        start = self._buf.find(b"\x00\x00\x01")
+        if start == -1:
+            if len(self._buf) > self.max_nal_size:
+                del self._buf[:-2]
+            return nals
+        while True:
+            end = self._buf.find(b"\x00\x00\x01", start + 3)
+            if end == -1:
+                break
+            nal = bytes(self._buf[start + 3:end]).rstrip(b"\x00")
+            if nal:
+                nals.append(nal)
+            start = end
+        del self._buf[:start]
+        if len(self._buf) > self.max_nal_size:
+            self._buf.clear()
+        return nals
+
+
+@lru_cache()
+def passthrough_args() -> List[str]:
+    """Options for :code:`ffmpeg` to output every decoded frame without duplicating or dropping
+
+    :code:`-fps_mode` is only in ffmpeg 5.1 and later, older ones (4.3 in
+    Raspberry Pi OS bullseye) have :code:`-vsync` instead.
+
+    """
+    try:
+        version = subprocess.run(["ffmpeg", "-version"], capture_output=True,
+                                 text=True).stdout
+    except OSError:
+        version = ""
+    match = re.match(r"ffmpeg version n?(\d+)\.(\d+)", version)
+    if match and (int(match.group(1)), int(match.group(2))) < (5, 1):
+        return ["-vsync", "0"]
+    return ["-fps_mode", "passthrough"]
+
+
+class FfmpegDecoder:
+    """Decode an H.264 Annex B stream with an :code:`ffmpeg` subprocess.
+
+    NAL units are written to the stdin of :code:`ffmpeg` and decoded BGR
+    frames are read from its stdout.
+
+    Args:
+        width: Frame width of the stream
+        height: Frame height of the stream
+
+    """
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.frame_size = width * height * 3
+        self._proc = subprocess.Popen(
+            ["ffmpeg", "-loglevel", "error",
+             "-probesize", "32", "-analyzeduration", "0",
+             "-f", "h264", "-i", "pipe:0",
+             *passthrough_args(), "-f", "rawvideo", "-pix_fmt", "bgr24",
+             "-s", f"{width}x{height}", "pipe:1"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+
+    def write(self, nal: bytes):
+        self._proc.stdin.write(START_CODE + nal)
+
+    def read(self):
+        """Read the next decoded frame. Returns :code:`None` when the stream ends."""
+        buf = bytearray(self.frame_size)
+        view = memoryview(buf)
+        received = 0
+        while received < self.frame_size:
+            n = self._proc.stdout.readinto(view[received:])
+            if not n:
+                return None
+            received += n
+        return np.frombuffer(buf, dtype=np.uint8).reshape(self.height, self.width, 3)
+
+    def close(self):
+        try:
+            self._proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self._proc.wait()
+
 
 class Client:
-    def __init__(self, host, port):
+    """Client for the H.264 TCP stream of :meth:`streamer.Streamer.start_tcp`
+
+    Three threads are run. One receives bytes from the socket into a bounded
+    :class:`ByteRing`, one parses NAL units out of it and feeds the decoder and
+    one reads the decoded frames.
+
+    Decoding starts at the first keyframe. If the ring overflows, as when the
+    client can't keep up, the partial data is dropped and decoding resumes at
+    the next keyframe with the last seen SPS and PPS.
+
+    Args:
+        host: Host of the streamer
+        port: Port of the streamer
+        size: Frame size [width, height] of the stream
+        latest_only: Keep only the latest decoded frame and drop the stale
+                     ones. Otherwise up to :code:`queue_size` frames are kept
+                     and the decoder is blocked when they're not consumed.
+        ring_size: Size of the byte ring in bytes
+        queue_size: Maximum number of decoded frames kept if not :code:`latest_only`
+
+    """
+    def __init__(self, host, port, size=[1280, 720], latest_only: bool = True,
+                 ring_size: int = 1024 * 1024, queue_size: int = 4):
         self.host = host
         self.port = port
+        self.size = size
+        self.latest_only = latest_only
         self.done = Event()
-        self.q = Queue()
+        self.ring = ByteRing(ring_size)
+        self.parser = NALParser()
+        self.frames = LatestFrame() if latest_only else Queue(maxsize=queue_size)
+        self._sps = None
+        self._pps = None
+        self._last_read = 0
+        self._threads = []
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((self.host, self.port))
         print("Connected to socket")
 
-    def recv_2048(self):
-        chunks = []
-        bytes_recvd = 0
-        # bytes_recvd < MSGLEN
-        i = 0
-        while True and not self.done.is_set():
-            chunk = self.sock.recv(2048)
-            if chunk == b'':
-                return b''.join(chunks)
-            chunks.append(chunk)
-            bytes_recvd = bytes_recvd + len(chunk)
-            i += 1
-            if bytes_recvd and bytes_recvd > (256*1024):
-                self.q.put(b''.join(chunks))
-                chunks = []
-                print(i, bytes_recvd)
-                bytes_recvd = 0
-            if not (i+1) % 100:
-                print(i, bytes_recvd)
-        self.q.put(b''.join(chunks))
-
     def recv(self):
-        while True and not self.done.is_set():
-            chunk = self.sock.recv(2048)
-            self.q.put(chunk)
+        while not self.done.is_set():
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                break
+            self.ring.write(chunk)
+        self.ring.close()
 
-    def start(self):
-        t = Thread(target=self.recv)
-        t.start()
+    def feed(self, decoder):
+        synced = False
+        while not self.done.is_set():
+            data, overflowed = self.ring.read(timeout=.5)
+            if overflowed:
+                self.parser.reset()
+                synced = False
+            if not data and not self.ring.closed:
+                continue
+            nals = self.parser.feed(data) if data else self.parser.flush()
+            for nal in nals:
+                nal_type = nal[0] & 0x1F
+                if nal_type == NAL_SPS:
+                    self._sps = nal
+                elif nal_type == NAL_PPS:
+                    self._pps = nal
+                if not synced:
+                    if nal_type == NAL_SPS:
+                        synced = True
+                    elif nal_type == NAL_IDR and self._sps and self._pps:
+                        decoder.write(self._sps)
+                        decoder.write(self._pps)
+                        synced = True
+                    else:
+                        continue
+                decoder.write(nal)
+            if not data:
+                break
+        decoder.close()
 
+    def decode(self, decoder):
+        while True:
+            frame = decoder.read()
+            if frame is None:
+                break
+            if self.latest_only:
+                self.frames.publish(frame)
+            else:
+                while not self.done.is_set():
+                    try:
+                        self.frames.put(frame, timeout=.5)
+                        break
+                    except Full:
+                        pass
+
+    def read(self, timeout: Optional[float] = None):
+        """Return the next decoded frame or :code:`None` if none arrives within :code:`timeout`"""
+        if self.latest_only:
+            count, timestamp, frame = self.frames.wait(self._last_read, timeout)
+            if frame is not None:
+                self._last_read = count
+            return frame
         try:
-            while not self.done.is_set():
-                data = self.q.get()
-                # print("Writing")
-                # with open("test.mp4", "wb") as f:
-                #     f.write(data)
-                buf = BytesIO(data)
-                cap = cv.VideoCapture(buf)
+            return self.frames.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def stop(self):
+        self.done.set()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        for t in self._threads:
             t.join()
-            self.sock.close()
+        self.sock.close()
+
+    def start(self):
+        decoder = FfmpegDecoder(*self.size)
+        self._threads = [Thread(target=self.recv), Thread(target=self.feed, args=(decoder,)),
+                         Thread(target=self.decode, args=(decoder,))]
+        for t in self._threads:
+            t.start()
+        try:
+            while not self.done.is_set():
+                frame = self.read(timeout=1)
+                if frame is None:
+                    if not self._threads[2].is_alive():
+                        break
+                    continue
+                cv.imshow("img", frame)
+                if cv.waitKey(1) == ord('q'):
+                    break
         except KeyboardInterrupt:
             print("Interrupt")
-            self.done.set()
-            t.join()
-            self.sock.close()
+        cv.destroyAllWindows()
+        self.stop()
 
 
 if __name__ == '__main__':
@@ -72,6 +321,10 @@ if __name__ == '__main__':
     parser.add_argument("hostname")
     parser.add_argument("-p", "--port", type=int, default=8080)
     parser.add_argument("-f", "--frame-rate", type=int, default=25)
+    parser.add_argument("-s", "--size", default="1280,720")
+    parser.add_argument("--all-frames", dest="latest_only", action="store_false",
+                        help="Decode and show every frame instead of only the latest one")
     args = parser.parse_args()
-    client = Client(args.hostname, args.port)
+    size = [*map(int, args.size.split(","))]
+    client = Client(args.hostname, args.port, size, latest_only=args.latest_only)
     client.start()
@@ -1,23 +1,18 @@
 import argparse
-import socket
 import time
 
 from picamera2 import Picamera2
 from picamera2.encoders import H264Encoder
-from picamera2.outputs import FileOutput, FfmpegOutput
 
+from broadcaster import H264Broadcaster
 
 
 def main(port, frame_rate, bit_rate, size):
     hostname = "0.0.0.0"
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind((hostname, port))
     cam = Picamera2()
     video_config = cam.create_video_configuration({"size": size})
     cam.configure(video_config)
-    encoder = H264Encoder(bit_rate)
-    sock.listen(0)
+    encoder = H264Encoder(bit_rate, repeat=True, iperiod=frame_rate)
     cam.framerate = 24
 
 
@@ -35,17 +30,13 @@ def main(port, frame_rate, bit_rate, size):
     #     sock.close()
 
     try:
-        conn, addr = sock.accept()
-        stream = conn.makefile("wb")
-        output = FileOutput(stream)
-        cam.start_recording(encoder, stream)
-        # server only 1 second
+        output = H264Broadcaster(hostname, port)
+        cam.start_recording(encoder, output)
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
         cam.stop_recording()
-        conn.close()
-        sock.close()
+        output.close()
 
 
 if __name__ == '__main__':
@@ -1,15 +1,24 @@
 from typing import Dict, Optional
-import base64
-from threading import Thread, Event
-from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+import time
+import argparse
+from threading import Thread, Event, Lock
 
+import numpy as np
 import cv2 as cv
 
-from flask import Flask, request
+from flask import Flask, Response, request
 from werkzeug import serving
 from common_pyutil.monitor import Timer
 
-from sc08a import SC08A
+import repo_dirs
+repo_dirs.add("streaming", "sc08a")
+
+from sc08a import SC08A, Trajectory, TrajectoryExecutor
+from object_tracking import ROITracker
+from pid import PIDController
+from frame_cache import (EncodedFrameCache, LatestFrame, binary_frame, frame_request,
+                         parse_variant, wait_timeout)
 
 
 def gstreamer_pipeline(width=1280, height=720, flip_180=False):
@@ -26,13 +35,15 @@ timer = Timer()
 # Bufferless VideoCapture
 # Adapted from https://stackoverflow.com/a/54577746/16723964
 class VideoCapture:
-    def __init__(self, pipeline, cap_type):
+    def __init__(self, pipeline, cap_type, latest: Optional[LatestFrame] = None):
         self._cap = cv.VideoCapture(pipeline, cap_type)
-        self.q = Queue()
-        self._reader_thread = Thread(target=self._reader)
-        self._reader_thread.start()
+        # Publish to the LatestFrame of the owner if given, so that its waiters
+        # carry on with the next capture when this one is replaced
+        self._latest = latest or LatestFrame()
         self._should_read = Event()
         self._should_read.set()
+        self._reader_thread = Thread(target=self._reader)
+        self._reader_thread.start()
 
     # read frames as soon as they are available, keeping only most recent one
     def _reader(self):
@@ -40,12 +51,12 @@ class VideoCapture:
             ret, frame = self._cap.read()
             if not ret:
                 break
-            if not self.q.empty():
-                try:
-                    self.q.get_nowait()  # discard previous (unprocessed) frame
-                except Queue.Empty:
-                    pass
-            self.q.put(frame)
+            self._latest.publish(frame)
+
+    @property
+    def count(self):
+        """A count of the number of frames read."""
+        return self._latest.count
 
     def stop(self):
         self._should_read.clear()
@@ -58,9 +69,19 @@ class VideoCapture:
     def release(self):
         self.stop()
 
+    def read_with_timestamp(self, previous=None, timeout=None):
+        """Wait for a frame newer than the sequence number :code:`previous`
+
+        Any number of readers can wait at once and they all get the same frame.
+        See :meth:`LatestFrame.wait`
+
+        """
+        return self._latest.wait(previous, timeout)
+
     def read(self):
         if self._should_read.is_set():
-            return True, self.q.get()
+            count, timestamp, frame = self._latest.wait(timeout=1)
+            return frame is not None, frame
         else:
             return False, None
 
@@ -71,6 +92,17 @@ class TwoDOFArm:
 
     The camera is captured and images are read on demand via HTTP requests.
 
+    The arm can also track an object of a colour range on board (see
+    :meth:`start_tracking`). The tracker runs next to the capture at camera
+    rate and drives the :class:`SC08A` directly, instead of a remote client
+    fetching the frames and sending the moves over HTTP.
+
+    A timed trajectory of the motors can be uploaded with
+    :code:`/run_trajectory` (see :class:`sc08a.Trajectory`, the channels can be
+    given by their names in :code:`pins`) and is run by a
+    :class:`sc08a.TrajectoryExecutor`. Tracking and a trajectory stop each
+    other.
+
     Args:
         width: Image width to capture
         height: Image height to capture
@@ -79,25 +111,39 @@ class TwoDOFArm:
               horizontal plane and which in the vertical plane
         serial_port: The serial port to which :class:`SC08A` is connected
         baudrate: Optional baudrate of the serial port, defaults to 9600 in :code:`SC08A`
+        resync_interval: If given, correct the position model of :class:`SC08A`
+                         from the motors every :code:`resync_interval` seconds
 
     """
     def __init__(self, width, height, http_port, pins: Dict[str, int], serial_port: str,
-                 baudrate: Optional[int] = None):
+                 baudrate: Optional[int] = None, resync_interval: Optional[float] = None):
         self._width = width
         self._height = height
         self._flip = True
         self._gst_pipeline = gstreamer_pipeline(width, height, flip_180=self._flip)
         # self._cap = cv.VideoCapture(self._gst_pipeline, cv.CAP_GSTREAMER)
-        self._cap = VideoCapture(self._gst_pipeline, cv.CAP_GSTREAMER)
+        self._latest = LatestFrame()
+        self._cap = VideoCapture(self._gst_pipeline, cv.CAP_GSTREAMER, self._latest)
+        self._cache = EncodedFrameCache()
         self.port = http_port
         self.app = Flask("Frame Server")
         self.pins = pins
         self.serial_port = serial_port
         self.baudrate = baudrate
-        self.init_controller()
+        self.resync_interval = resync_interval
+        self._controller_lock = Lock()
+        self.controller: Optional[SC08A] = None
+        self.executor: Optional[TrajectoryExecutor] = None
         self.default_speed = 100
         self.default_increment = 100
         self.app = Flask("Servo")
+        self.tracking_controllers = tuple(
+            PIDController(kp=.1, output_limits=(-100, 100), deadband=5) for _ in range(2))
+        self._tracker = ROITracker(np.array([163, 74, 30]), np.array([179, 255, 255]))
+        self._tracking = Event()
+        self._tracking_thread: Optional[Thread] = None
+        self._tracking_status = LatestFrame()
+        self.init_controller()
 
     def set_capture_properties(self, width, height, flip_180):
         self._width = width
@@ -106,176 +152,404 @@ class TwoDOFArm:
         self._gst_pipeline = gstreamer_pipeline(self._width, self._height, self._flip)
         if self._cap.isOpened():
             self._cap.release()
-        self._cap = cv.VideoCapture(self._gst_pipeline, cv.CAP_GSTREAMER)
+        # The sequence numbers carry on in self._latest, but the frames of the
+        # old capture are of no use any more
+        self._cache.clear()
+        self._cap = VideoCapture(self._gst_pipeline, cv.CAP_GSTREAMER, self._latest)
 
     def init_controller(self):
+        """Open the controller, replacing the current one
+
+        Tracking, a running trajectory and the resync of the current
+        controller are stopped first so that nothing writes to it any more.
+
+        """
+        self.stop_tracking()
+        if self.executor is not None:
+            self.executor.cancel()
+        if self.controller is not None:
+            with self._controller_lock:
+                self.controller.close()
         self.controller = SC08A(self.serial_port, self.baudrate)
         self.controller.init_all_motors()
+        if self.resync_interval:
+            self.controller.start_resync(self.pins.values(), self.resync_interval)
+        self.executor = TrajectoryExecutor(self.controller, self._controller_lock)
 
     def start(self):
         self.init_routes()
-        serving.run_simple("0.0.0.0", self.port, self.app)
+        serving.run_simple("0.0.0.0", self.port, self.app, threaded=True)
+
+    def start_async(self):
+        """Start with an asyncio server instead of werkzeug.
+
+        Frame waiters await an asyncio event rather than blocking a thread
+        each. The control routes share the same event loop and run on a single
+        worker thread, which also serializes access to the serial port.
+        :code:`/tracking_status` waits for the next status, so it runs on
+        its own threads instead of holding up the control routes.
+
+        """
+        import async_server
+        self.init_handlers()
+        handlers = dict(self.handlers)
+        long_polls = {"/tracking_status": handlers.pop("/tracking_status")}
+        app = async_server.web.Application()
+        async_server.add_frame_routes(app, self._latest, self._cache)
+        async_server.add_handler_routes(app, handlers, ThreadPoolExecutor(max_workers=1))
+        async_server.add_handler_routes(app, long_polls, ThreadPoolExecutor(max_workers=4))
+        async_server.run(app, self.port)
 
     def _move_horizontal(self, speed, delta=None):
         pin = self.pins["left_right"]
-        cur_pos = self.controller.get_pos(pin)
         delta = delta or self.default_increment
-        pos = cur_pos + delta
-        self.controller.set_pos_speed(pin, pos, speed)
+        with self._controller_lock:
+            pos = self.controller.move_relative(pin, delta, speed)
         return f"Setting position for motor: {pin} at: {pos} and speed: {speed}"
 
     def _move_vertical(self, speed, delta=None):
         pin = self.pins["up_down"]
-        cur_pos = self.controller.get_pos(pin)
         delta = delta or self.default_increment
-        pos = cur_pos + delta
-        self.controller.set_pos_speed(pin, pos, speed)
+        with self._controller_lock:
+            pos = self.controller.move_relative(pin, delta, speed)
         return f"Setting position for motor: {pin} at: {pos} and speed: {speed}"
 
     def _go_left_right(self, lr, speed, delta=None):
         pin = self.pins["left_right"]
-        cur_pos = self.controller.get_pos(pin)
         delta = delta or self.default_increment
-        if lr == "left":
-            pos = cur_pos + delta
-        else:
-            pos = cur_pos - delta
-        self.controller.set_pos_speed(pin, pos, speed)
+        with self._controller_lock:
+            pos = self.controller.move_relative(pin, delta if lr == "left" else -delta, speed)
         return f"Setting position for motor: {pin} at: {pos} and speed: {speed}"
 
     def _go_up_down(self, ud, speed, delta=None):
         pin = self.pins["up_down"]
-        cur_pos = self.controller.get_pos(pin)
         delta = delta or self.default_increment
-        if ud == "up":
-            pos = cur_pos - delta
-        else:
-            pos = cur_pos + delta
-        self.controller.set_pos_speed(pin, pos, speed)
+        with self._controller_lock:
+            pos = self.controller.move_relative(pin, -delta if ud == "up" else delta, speed)
         return f"Setting position for motor: {pin} at: {pos} and speed: {speed}"
 
-    def init_routes(self):
-        def _maybe_get_speed(request):
-            if "speed" not in request.args:
+    def set_target(self, low_val, high_val):
+        """Set the HSV colour range of the object to track"""
+        self._tracker.low_val = np.array(low_val)
+        self._tracker.high_val = np.array(high_val)
+        self._tracker.reset()
+
+    def start_tracking(self, speed: Optional[int] = None):
+        """Start tracking the target object in a separate thread
+
+        Each frame the object is found with :class:`ROITracker` and the motors
+        are moved by the outputs of :code:`tracking_controllers` (horizontal and
+        vertical :class:`PIDController`) for the offset in pixels of the object
+        from the center of the image. The moves are relative to the commanded
+        positions kept by :class:`SC08A`, so the positions aren't read from
+        the controller.
+
+        Args:
+            speed: Speed of the motors, :code:`default_speed` if not given
+
+        """
+        if self._tracking.is_set():
+            return
+        self.executor.cancel()
+        self._tracking.set()
+        self._tracking_thread = Thread(target=self._track_loop,
+                                       args=(speed or self.default_speed,), daemon=True)
+        self._tracking_thread.start()
+
+    def stop_tracking(self):
+        self._tracking.clear()
+        if self._tracking_thread is not None:
+            self._tracking_thread.join()
+            self._tracking_thread = None
+
+    def _track_loop(self, speed):
+        try:
+            self._track(speed)
+        finally:
+            # So that tracking can be started again if it failed
+            self._tracking.clear()
+
+    def _track(self, speed):
+        names = "left_right", "up_down"
+        pins = tuple(self.pins[name] for name in names)
+        with self._controller_lock:
+            positions = [self.controller.target(pin) for pin in pins]
+        self._tracker.reset()
+        for controller in self.tracking_controllers:
+            controller.reset()
+        count = 0
+        while self._tracking.is_set():
+            count, timestamp, img = self._cap.read_with_timestamp(count, timeout=1)
+            if img is None:
+                continue
+            blob, _ = self._tracker.track(img)
+            status = {"seq": count, "timestamp": timestamp, "found": blob is not None}
+            if blob is not None:
+                height, width = img.shape[:2]
+                x_err = blob.centroid[0] - width / 2
+                y_err = blob.centroid[1] - height / 2
+                # Same directions as RemoteClient.simple_agent
+                x_controller, y_controller = self.tracking_controllers
+                steps = (int(x_controller.update(x_err, timestamp)),
+                         -int(y_controller.update(y_err, timestamp)))
+                with self._controller_lock:
+                    for i, (pin, step) in enumerate(zip(pins, steps)):
+                        if step:
+                            positions[i] = self.controller.move_relative(pin, step, speed)
+                status.update(centroid=blob.centroid, area=blob.area, bbox=blob.bbox,
+                              error=[x_err, y_err])
+            status.update(positions=dict(zip(names, positions)),
+                          latency=time.time() - timestamp)
+            self._tracking_status.publish(status, timestamp)
+
+    def tracking_status(self, previous: Optional[int] = None, timeout: Optional[float] = None):
+        """Return the tracking status newer than the status :code:`id` :code:`previous`
+
+        The status has its :code:`id`, the frame sequence number and timestamp, whether the
+        object was found, its centroid, area and bbox, the motor positions and
+        the latency from the capture. The latest status is returned at once if
+        :code:`previous` isn't given. It's :code:`None` if there's no newer
+        status within :code:`timeout`.
+
+        """
+        if previous is None:
+            count, timestamp, status = self._tracking_status.snapshot()
+        else:
+            count, timestamp, status = self._tracking_status.wait(previous, timeout)
+        if status is not None:
+            status = {**status, "id": count, "tracking": self._tracking.is_set()}
+        return status
+
+    def init_handlers(self):
+        """Initialize the handlers for the control routes.
+
+        Each handler takes the request parameters and returns the response
+        text, or a :class:`dict` which is sent as JSON, so that the same
+        handlers serve both :meth:`start` and :meth:`start_async`.
+
+        """
+        def _maybe_get_speed(args):
+            if "speed" not in args:
                 print("speed not given. Will use 50")
                 speed = self.default_speed
             else:
-                speed = int(request.args.get("speed"))
+                speed = int(args.get("speed"))
             return speed
 
-        def _maybe_get_delta(request):
-            if "delta" in request.args:
-                return int(request.args.get("delta"))
+        def _maybe_get_delta(args):
+            if "delta" in args:
+                return int(args.get("delta"))
             else:
                 return None
 
-        def _get_pin():
-            if "pin" not in request.args:
-                return "Pin not given"
-            pin = int(request.args.get("pin"))
+        def _get_pin(args):
+            if "pin" not in args:
+                return None
+            pin = int(args.get("pin"))
             return pin
 
-        @self.app.route("/set_motion_delta", methods=["GET"])
-        def _set_motion_delta():
-            if "delta" not in request.args:
+        def _set_motion_delta(args):
+            if "delta" not in args:
                 return "Delta not given"
             else:
-                delta = int(request.args.get("delta"))
+                delta = int(args.get("delta"))
             self.default_increment = delta
             return f"Delta set to {delta}"
 
-        @self.app.route("/set_speed", methods=["GET"])
-        def _set_speed():
-            if "speed" not in request.args:
+        def _set_speed(args):
+            if "speed" not in args:
                 return "Speed not given"
             else:
-                speed = int(request.args.get("speed"))
+                speed = int(args.get("speed"))
             self.default_speed = speed
             return f"Speed set to {speed}"
 
-        @self.app.route("/set_capture_properties", methods=["GET"])
-        def _set_capture_properties():
-            width = request.args.get("width")
-            height = request.args.get("height")
-            flip = request.args.get("flip")
+        def _set_capture_properties(args):
+            width = int(args.get("width", self._width))
+            height = int(args.get("height", self._height))
+            flip = args.get("flip", str(self._flip)).lower() in {"1", "true", "yes"}
             self.set_capture_properties(width, height, flip)
+            return f"Capture properties set to width: {width}, height: {height}, flip: {flip}"
 
-        @self.app.route("/get_frame", methods=["GET"])
-        def __get_frame():
-            with timer:
-                status, img = self._cap.read()
-            # print("read time", timer.time)
-            with timer:
-                status, buf = cv.imencode(".jpg", img)
-            # print("encode time", timer.time)
-            data = base64.b64encode(buf)
-            return data
+        def _horizontal(args):
+            return self._move_horizontal(_maybe_get_speed(args), _maybe_get_delta(args))
+
+        def _vertical(args):
+            return self._move_vertical(_maybe_get_speed(args), _maybe_get_delta(args))
+
+        def _go_left(args):
+            return self._go_left_right("left", _maybe_get_speed(args), _maybe_get_delta(args))
 
-        @self.app.route("/horizontal", methods=["GET"])
-        def _horizontal():
-            speed = _maybe_get_speed(request)
-            delta = _maybe_get_delta(request)
-            return self._move_horizontal(speed, delta)
-
-        @self.app.route("/vertical", methods=["GET"])
-        def _vertical():
-            speed = _maybe_get_speed(request)
-            delta = _maybe_get_delta(request)
-            return self._move_vertical(speed, delta)
-
-        @self.app.route("/go_left", methods=["GET"])
-        def _go_left():
-            speed = _maybe_get_speed(request)
-            delta = _maybe_get_delta(request)
-            return self._go_left_right("left", speed, delta)
-
-        @self.app.route("/go_right", methods=["GET"])
-        def _go_right():
-            speed = _maybe_get_speed(request)
-            delta = _maybe_get_delta(request)
-            return self._go_left_right("right", speed, delta)
-
-        @self.app.route("/go_up", methods=["GET"])
-        def _go_up():
-            speed = _maybe_get_speed(request)
-            delta = _maybe_get_delta(request)
-            return self._go_up_down("up", speed, delta)
-
-        @self.app.route("/go_down", methods=["GET"])
-        def _go_down():
-            speed = _maybe_get_speed(request)
-            delta = _maybe_get_delta(request)
-            return self._go_up_down("down", speed, delta)
-
-        @self.app.route("/get_pos", methods=["GET"])
-        def _get_pos():
-            pin = _get_pin(request)
+        def _go_right(args):
+            return self._go_left_right("right", _maybe_get_speed(args), _maybe_get_delta(args))
+
+        def _go_up(args):
+            return self._go_up_down("up", _maybe_get_speed(args), _maybe_get_delta(args))
+
+        def _go_down(args):
+            return self._go_up_down("down", _maybe_get_speed(args), _maybe_get_delta(args))
+
+        def _get_pos(args):
+            pin = _get_pin(args)
+            if pin is None:
+                return "Pin not given"
             return str(self.controller.get_pos(pin))
 
-        @self.app.route("/reset", methods=["GET"])
-        def _reset():
-            pin = _get_pin(request)
+        def _get_all_pos(args):
+            positions = self.controller.get_positions(self.pins.values())
+            return {name: positions[pin] for name, pin in self.pins.items()}
+
+        def _reset(args):
+            pin = _get_pin(args)
+            if pin is None:
+                return "Pin not given"
             self.controller.off_motor(pin)
             return f"Turning motor {pin} OFF"
 
-        @self.app.route("/reset_all", methods=["GET"])
-        def _reset_all():
+        def _reset_all(args=None):
             for pin in self.pins.values():
                 self.controller.off_motor(pin)
             return "Issued OFF command for all motors"
 
-        @self.app.route("/close", methods=["GET"])
-        def _close():
+        def _close(args=None):
+            self.stop_tracking()
+            self.executor.cancel()
             _reset_all()
             self.controller.shutdown()
             return "Stopped all motors and turned off the controller"
 
-        @self.app.route("/start", methods=["GET"])
-        def _start():
+        def _start(args=None):
             self.init_controller()
             return "Initialized the controller"
 
+        def _parse_values(value):
+            return [*map(int, value.split(","))]
+
+        def _set_target(args):
+            if "low" not in args or "high" not in args:
+                return "low and high HSV values not given"
+            self.set_target(_parse_values(args.get("low")), _parse_values(args.get("high")))
+            return f"Tracking target set to low: {args.get('low')}, high: {args.get('high')}"
+
+        def _start_tracking(args):
+            if "low" in args and "high" in args:
+                _set_target(args)
+            try:
+                speed = int(args.get("speed")) if "speed" in args else None
+                if speed is not None:
+                    SC08A.check_command(0, 0, speed)
+            except ValueError as e:
+                return f"Invalid speed: {e}"
+            self.start_tracking(speed)
+            return "Started tracking"
+
+        def _stop_tracking(args=None):
+            self.stop_tracking()
+            return "Stopped tracking"
+
+        def _tracking_status(args):
+            try:
+                after = int(args.get("after")) if "after" in args else None
+                timeout = wait_timeout(args)
+            except ValueError as e:
+                return f"Invalid after or timeout: {e}"
+            status = self.tracking_status(after, timeout)
+            return status or {"tracking": self._tracking.is_set()}
+
+        def _run_trajectory(args):
+            if "trajectory" not in args:
+                return "Trajectory not given"
+            try:
+                trajectory = Trajectory.from_json(args["trajectory"], self.pins)
+            except ValueError as e:
+                return str(e)
+            self.stop_tracking()
+            traj_id = self.executor.run(trajectory)
+            return f"Trajectory {traj_id}: Running for {trajectory.duration}s"
+
+        def _cancel_trajectory(args=None):
+            if self.executor.cancel():
+                return "Cancelled the trajectory"
+            return "No trajectory running"
+
+        def _trajectory_status(args=None):
+            return self.executor.status()
+
+        self.handlers = {"/set_motion_delta": _set_motion_delta,
+                         "/set_speed": _set_speed,
+                         "/set_capture_properties": _set_capture_properties,
+                         "/horizontal": _horizontal,
+                         "/vertical": _vertical,
+                         "/go_left": _go_left,
+                         "/go_right": _go_right,
+                         "/go_up": _go_up,
+                         "/go_down": _go_down,
+                         "/get_pos": _get_pos,
+                         "/get_all_pos": _get_all_pos,
+                         "/reset": _reset,
+                         "/reset_all": _reset_all,
+                         "/close": _close,
+                         "/start": _start,
+                         "/set_target": _set_target,
+                         "/start_tracking": _start_tracking,
+                         "/stop_tracking": _stop_tracking,
+                         "/tracking_status": _tracking_status,
+                         "/run_trajectory": _run_trajectory,
+                         "/cancel_trajectory": _cancel_trajectory,
+                         "/trajectory_status": _trajectory_status}
+
+    def init_routes(self):
+        self.init_handlers()
+        for path, handler in self.handlers.items():
+            self.app.add_url_rule(path, path, self._flask_view(handler), methods=["GET"])
+
+        @self.app.route("/get_frame", methods=["GET"])
+        def __get_frame():
+            try:
+                variant = parse_variant(request.args)
+            except ValueError as e:
+                return str(e), 400
+            with timer:
+                count, timestamp, img = self._cap.read_with_timestamp()
+            # print("read time", timer.time)
+            with timer:
+                data = self._cache.b64(count, img, variant)
+            # print("encode time", timer.time)
+            return data
+
+        @self.app.route("/frame", methods=["GET"])
+        def __frame():
+            try:
+                after, timeout = frame_request(request.args, request.headers)
+            except ValueError as e:
+                return str(e), 400
+            count, timestamp, img = self._cap.read_with_timestamp(after, timeout)
+            if img is None:
+                return Response(status=304)
+            try:
+                data, mimetype, headers = binary_frame(self._cache, count, timestamp, img,
+                                                       request.args.get("format", "jpg"),
+                                                       parse_variant(request.args))
+            except ValueError as e:
+                return str(e), 400
+            return Response(data, mimetype=mimetype, headers=headers)
+
+    @staticmethod
+    def _flask_view(handler):
+        def _view():
+            return handler(request.args)
+        return _view
+
 
 if __name__ == '__main__':
-    arm = TwoDOFArm(640, 480, 8080, {"left_right": 1, "up_down": 2}, "/dev/ttyUSB0")
-    arm.start()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--asyncio", action="store_true", help="Use the asyncio server")
+    parser.add_argument("--resync-interval", type=float,
+                        help="Seconds between reads of the motor positions to correct the model")
+    args = parser.parse_args()
+    arm = TwoDOFArm(640, 480, 8080, {"left_right": 1, "up_down": 2}, "/dev/ttyUSB0",
+                    resync_interval=args.resync_interval)
+    if args.asyncio:
+        arm.start_async()
+    else:
+        arm.start()
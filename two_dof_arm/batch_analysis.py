@@ -0,0 +1,141 @@
+from typing import Dict, List, Optional
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import cv2 as cv
+
+from object_tracking import ROITracker
+
+
+video_extensions = {".mp4", ".mkv", ".avi", ".mov", ".h264", ".ts"}
+columns = {"video": np.int32, "frame": np.int32, "found": np.bool_,
+           "cx": np.float32, "cy": np.float32, "area": np.int32,
+           "x": np.int32, "y": np.int32, "w": np.int32, "h": np.int32}
+
+
+def frame_ranges(path: str, chunk_frames: int):
+    """Split a video into ranges of at most :code:`chunk_frames` frames
+
+    If the container doesn't tell the number of frames, the whole video is one
+    range with :code:`None` as its end.
+
+    """
+    cap = cv.VideoCapture(path)
+    num_frames = int(cap.get(cv.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if num_frames <= 0:
+        return [(0, None)]
+    return [(start, min(start + chunk_frames, num_frames))
+            for start in range(0, num_frames, chunk_frames)]
+
+
+def _init_worker():
+    # Each worker process decodes and thresholds on one core
+    cv.setNumThreads(1)
+
+
+def analyse_range(video: int, path: str, start: int, stop: Optional[int],
+                  low_val, high_val, hsv: bool = True) -> Dict[str, np.ndarray]:
+    """Track the object in frames :code:`start` to :code:`stop` of a video
+
+    Runs in a worker process. The tracker starts with a full frame search at
+    :code:`start`.
+
+    Returns:
+        A :class:`dict` of the :data:`columns` with a row per frame
+
+    """
+    cap = cv.VideoCapture(path)
+    if start:
+        cap.set(cv.CAP_PROP_POS_FRAMES, start)
+    tracker = ROITracker(np.array(low_val), np.array(high_val), hsv=hsv)
+    rows = []
+    index = start
+    while stop is None or index < stop:
+        status, frame = cap.read()
+        if not status:
+            break
+        blob, _ = tracker.track(frame)
+        if blob is None:
+            rows.append((video, index, False, np.nan, np.nan, 0, 0, 0, 0, 0))
+        else:
+            rows.append((video, index, True, *blob.centroid, blob.area, *blob.bbox))
+        index += 1
+    cap.release()
+    if not rows:
+        return {name: np.empty(0, dtype=dtype) for name, dtype in columns.items()}
+    values = list(zip(*rows))
+    return {name: np.array(values[i], dtype=dtype)
+            for i, (name, dtype) in enumerate(columns.items())}
+
+
+def find_videos(directory: str) -> List[str]:
+    return sorted(str(p) for p in Path(directory).iterdir()
+                  if p.suffix.lower() in video_extensions)
+
+
+def analyse(paths: List[str], output: str, low_val, high_val, hsv: bool = True,
+            workers: Optional[int] = None, chunk_frames: int = 500):
+    """Track the object in all frames of the videos with a process pool
+
+    Each video is split into ranges of :code:`chunk_frames` frames and the
+    ranges of all the videos are spread over the workers. The rows are sorted
+    by video and frame and written as columns to a compressed :code:`.npz`
+    file, along with the paths of the videos, which the :code:`video` column
+    indexes.
+
+    Args:
+        paths: Paths of the videos
+        output: Output :code:`.npz` file
+        low_val: Low threshold per channel
+        high_val: High threshold per channel
+        hsv: Threshold in HSV instead of BGR
+        workers: Number of worker processes, the number of cores if not given
+        chunk_frames: Frames per task
+
+    """
+    if not paths:
+        raise ValueError("No videos to analyse")
+    tasks = [(video, path, start, stop)
+             for video, path in enumerate(paths)
+             for start, stop in frame_ranges(path, chunk_frames)]
+    workers = workers or os.cpu_count()
+    start_time = time.time()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        futures = [executor.submit(analyse_range, *task, list(low_val), list(high_val), hsv)
+                   for task in tasks]
+        for i, future in enumerate(futures):
+            results.append(future.result())
+            print(f"{i + 1}/{len(tasks)} ranges done")
+    table = {name: np.concatenate([r[name] for r in results]) for name in columns}
+    order = np.lexsort((table["frame"], table["video"]))
+    table = {name: column[order] for name, column in table.items()}
+    np.savez_compressed(output, videos=np.array(paths), **table)
+    duration = time.time() - start_time
+    print(f"Analysed {len(order)} frames of {len(paths)} videos in {duration:.1f}s "
+          f"({len(order) / duration:.1f} fps) with {workers} workers")
+    return table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Track the object in recorded videos")
+    parser.add_argument("input", help="Directory of videos or a video file")
+    parser.add_argument("-o", "--output", default="tracking.npz")
+    parser.add_argument("-lv", "--low-val", default="163,74,30")
+    parser.add_argument("-hv", "--high-val", default="179,255,255")
+    parser.add_argument("--bgr", action="store_true", help="Threshold in BGR instead of HSV")
+    parser.add_argument("-j", "--workers", type=int)
+    parser.add_argument("--chunk-frames", type=int, default=500)
+    args = parser.parse_args()
+    paths = find_videos(args.input) if os.path.isdir(args.input) else [args.input]
+    if not paths:
+        sys.exit(f"No videos with extensions {', '.join(sorted(video_extensions))} "
+                 f"in {args.input}")
+    analyse(paths, args.output, [*map(int, args.low_val.split(","))],
+            [*map(int, args.high_val.split(","))], not args.bgr, args.workers, args.chunk_frames)
@@ -0,0 +1,238 @@
+from typing import Callable, Dict, List, Optional
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+import numpy as np
+import cv2 as cv
+
+from object_tracking import (BlobDetector, HSVMaskLUT, ROITracker, calc_pos,
+                             get_contours_and_mask_bgr, get_contours_and_mask_hsv, get_mask_hsv,
+                             get_midpoints)
+
+
+# The synthetic target is red in BGR and in HSV
+target_color = (20, 60, 220)
+low_hsv = np.array([0, 120, 70])
+high_hsv = np.array([10, 255, 255])
+low_bgr = np.array([0, 0, 150])
+high_bgr = np.array([90, 90, 255])
+
+
+def synthetic_frames(width, height, num_frames=200, radius=None, noise=8, seed=0):
+    """Generate frames with a red disc moving on a Lissajous path over a noisy background
+
+    Args:
+        width: Frame width
+        height: Frame height
+        num_frames: Number of frames
+        radius: Radius of the disc, a twentieth of the height if not given
+        noise: Standard deviation of the gaussian noise
+        seed: Seed for the noise
+
+    """
+    rng = np.random.default_rng(seed)
+    radius = radius or height // 20
+    background = rng.integers(40, 120, (height, width, 3), dtype=np.uint8)
+    frames = []
+    for i in range(num_frames):
+        t = 2 * np.pi * i / num_frames
+        x = int(width / 2 + (width / 2 - 2 * radius) * np.sin(3 * t))
+        y = int(height / 2 + (height / 2 - 2 * radius) * np.sin(2 * t))
+        frame = background.copy()
+        cv.circle(frame, (x, y), radius, target_color, -1)
+        if noise:
+            frame = cv.add(frame, rng.normal(0, noise, frame.shape).astype(np.int8),
+                           dtype=cv.CV_8U)
+        frames.append(frame)
+    return frames
+
+
+def video_frames(path, num_frames=200):
+    """Read up to :code:`num_frames` frames of a recorded video into memory"""
+    cap = cv.VideoCapture(path)
+    frames = []
+    while len(frames) < num_frames:
+        status, frame = cap.read()
+        if not status:
+            break
+        frames.append(frame)
+    cap.release()
+    if not frames:
+        raise ValueError(f"Could not read frames from {path}")
+    return frames
+
+
+def _largest_contour_midpoint(contours):
+    areas = [cv.contourArea(x) for x in contours]
+    sorted_inds = np.argsort(areas)
+    return get_midpoints(contours[sorted_inds[-1]])
+
+
+def tracking_paths(low_hsv, high_hsv, low_bgr, high_bgr) -> Dict[str, Callable]:
+    """The tracking paths to benchmark
+
+    Each path is a function of the frame which finds the object and updates
+    the servo positions with :func:`calc_pos`, as in :func:`object_tracking.main`.
+    Stateful paths keep their state across the frames of a run.
+
+    """
+    def _with_calc_pos(find):
+        pos = [90, 90]
+
+        def _path(frame):
+            mid = find(frame)
+            if mid is not None:
+                rows, cols = frame.shape[:2]
+                pos[:] = calc_pos(*pos, *mid, cols // 2, rows // 2, 50, 50)
+        return _path
+
+    def _contours_hsv():
+        def find(frame):
+            contours, mask = get_contours_and_mask_hsv(frame, low_hsv, high_hsv)
+            return _largest_contour_midpoint(contours) if len(contours) else None
+        return _with_calc_pos(find)
+
+    def _contours_bgr():
+        def find(frame):
+            contours, mask = get_contours_and_mask_bgr(frame, low_bgr, high_bgr)
+            return _largest_contour_midpoint(contours) if len(contours) else None
+        return _with_calc_pos(find)
+
+    def _blob_hsv():
+        detector = BlobDetector()
+
+        def find(frame):
+            blob = detector.detect(get_mask_hsv(frame, low_hsv, high_hsv))
+            return blob and blob.midpoint
+        return _with_calc_pos(find)
+
+    def _blob_hsv_lut():
+        detector = BlobDetector()
+        threshold = HSVMaskLUT()
+
+        def find(frame):
+            blob = detector.detect(threshold(frame, low_hsv, high_hsv))
+            return blob and blob.midpoint
+        return _with_calc_pos(find)
+
+    def _roi_tracker_hsv():
+        tracker = ROITracker(low_hsv, high_hsv)
+
+        def find(frame):
+            blob, mask = tracker.track(frame)
+            return blob and blob.midpoint
+        return _with_calc_pos(find)
+
+    def _roi_tracker_lut():
+        tracker = ROITracker(low_hsv, high_hsv, lut=True)
+
+        def find(frame):
+            blob, mask = tracker.track(frame)
+            return blob and blob.midpoint
+        return _with_calc_pos(find)
+
+    return {"contours_hsv": _contours_hsv,
+            "contours_bgr": _contours_bgr,
+            "blob_hsv": _blob_hsv,
+            "blob_hsv_lut": _blob_hsv_lut,
+            "roi_tracker_hsv": _roi_tracker_hsv,
+            "roi_tracker_lut": _roi_tracker_lut}
+
+
+def run_path(make_path: Callable, frames: List[np.ndarray], warmup: int = 10):
+    """Time a tracking path over the frames and measure its allocations
+
+    The timing pass and the :mod:`tracemalloc` pass are separate, as tracing
+    slows down the allocations a lot.
+
+    Returns:
+        A :class:`dict` with fps, mean and p50/p95/p99 latency in ms, and the
+        mean and max per frame peak of traced allocations in KiB with the
+        number of blocks still allocated after the run.
+
+    """
+    path = make_path()
+    for frame in frames[:warmup]:
+        path(frame)
+    times = np.empty(len(frames))
+    for i, frame in enumerate(frames):
+        start = time.perf_counter()
+        path(frame)
+        times[i] = time.perf_counter() - start
+    times *= 1000
+
+    path = make_path()
+    peaks = np.empty(len(frames))
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i, frame in enumerate(frames):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        path(frame)
+        peaks[i] = tracemalloc.get_traced_memory()[1] - current
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+    return {"frames": len(frames),
+            "fps": float(len(frames) / times.sum() * 1000),
+            "mean_ms": float(times.mean()),
+            "p50_ms": float(np.percentile(times, 50)),
+            "p95_ms": float(np.percentile(times, 95)),
+            "p99_ms": float(np.percentile(times, 99)),
+            "alloc_peak_kib_mean": float(peaks.mean() / 1024),
+            "alloc_peak_kib_max": float(peaks.max() / 1024),
+            "retained_blocks": int(retained)}
+
+
+def compare(results, baseline):
+    """Print the change of p50 and p99 latency of each case from a baseline"""
+    for name, result in results["cases"].items():
+        base = baseline["cases"].get(name)
+        if base is None:
+            continue
+        print(f"{name}: p50 {result['p50_ms'] / base['p50_ms']:.2f}x, "
+              f"p99 {result['p99_ms'] / base['p99_ms']:.2f}x of baseline")
+
+
+def main(sizes, num_frames, paths: Optional[List[str]] = None, video=None,
+         output=None, baseline=None):
+    all_paths = tracking_paths(low_hsv, high_hsv, low_bgr, high_bgr)
+    paths = paths or list(all_paths)
+    if video:
+        sources = {video: video_frames(video, num_frames)}
+    else:
+        sources = {f"{w}x{h}": synthetic_frames(w, h, num_frames) for w, h in sizes}
+    results = {"platform": platform.platform(), "opencv": cv.__version__,
+               "numpy": np.__version__, "time": time.time(), "cases": {}}
+    for source, frames in sources.items():
+        for name in paths:
+            result = run_path(all_paths[name], frames)
+            results["cases"][f"{name}@{source}"] = result
+            print(f"{name}@{source}: {result['fps']:.1f} fps, p50 {result['p50_ms']:.2f} ms, "
+                  f"p95 {result['p95_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms, "
+                  f"peak alloc {result['alloc_peak_kib_mean']:.0f} KiB")
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    if baseline:
+        with open(baseline) as f:
+            compare(results, json.load(f))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the tracking paths offline")
+    parser.add_argument("--sizes", default="320x240,640x480,1280x720",
+                        help="Comma separated WxH sizes of the synthetic frames")
+    parser.add_argument("-n", "--num-frames", type=int, default=200)
+    parser.add_argument("--paths", help="Comma separated tracking paths to run, all by default")
+    parser.add_argument("--video", help="Replay frames from a recorded video instead")
+    parser.add_argument("-o", "--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare with the JSON results of an earlier run")
+    args = parser.parse_args()
+    sizes = [tuple(map(int, size.split("x"))) for size in args.sizes.split(",")]
+    main(sizes, args.num_frames, args.paths and args.paths.split(","), args.video,
+         args.output, args.baseline)
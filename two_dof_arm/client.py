@@ -1,44 +1,48 @@
 import argparse
-import base64
 
-import requests
-import numpy as np
 import cv2 as cv
 from common_pyutil.monitor import Timer
 
+import repo_dirs
+repo_dirs.add("streaming")
+
+from frame_client import FrameClient
+
 
 timer = Timer()
 
 
 def show_live(host, port, flip=0, convert=None):
-    server = f"http://{host}:{port}"
+    client = FrameClient(host, port)
+    client.start()
     i = 0
+    img = None
     while True:
         key = cv.waitKey(1)
         with timer:
-            resp = requests.get(f"{server}/get_frame")
+            seq, timestamp, frame = client.read(timeout=.05)
         print(timer.time)
-        img = cv.imdecode(np.frombuffer(base64.b64decode(resp.content), dtype=np.uint8),
-                          flags=cv.IMREAD_COLOR)
-        if convert:
-            img = img[:, :, ::-1]
+        if frame is not None:
+            img = frame[:, :, ::-1] if convert else frame
         if key == 81:
-            resp = requests.get(f"{server}/go_left")
+            resp = client.get("/go_left")
             print("Going left")
         if key == 82:
-            resp = requests.get(f"{server}/go_up")
+            resp = client.get("/go_up")
             print("Going up")
         elif key == 83:
-            resp = requests.get(f"{server}/go_right")
+            resp = client.get("/go_right")
             print("Going right")
         elif key == 84:
-            resp = requests.get(f"{server}/go_down")
+            resp = client.get("/go_down")
             print("Going down")
         # elif key == ord("a"):
         #     print("Setting new Rotation")
         elif key == ord("q") or key == 27:
             print("Aborted Rotation")
             break
+        if img is None:
+            continue
         try:
             cv.imshow("img", img)
             print(i)
@@ -46,6 +50,7 @@ def show_live(host, port, flip=0, convert=None):
         except KeyboardInterrupt:
             cv.destroyAllWindows()
     cv.destroyAllWindows()
+    client.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,92 @@
+from typing import Optional, Sequence
+
+import numpy as np
+
+
+class TargetEstimator:
+    """A constant velocity Kalman filter for the position of the tracked object
+
+    Measurements are the centroids of the object with the capture timestamps
+    of their frames. :meth:`predict` extrapolates the position to the time the
+    command is sent, compensating for the capture, transfer and processing
+    delay, and keeps giving a position through short dropouts of detection.
+
+    The state is :code:`[x, y, vx, vy]` in pixels and pixels per second, with
+    white noise acceleration as the process noise.
+
+    Args:
+        process_noise: Spectral density of the acceleration in px^2/s^3
+        measurement_noise: Variance of the measured centroid in px^2
+        max_coast: Seconds after the last measurement the prediction is
+                   still given. After that the track is lost and the next
+                   measurement starts a new one.
+        max_horizon: Maximum seconds to extrapolate beyond the last measurement,
+                     which guards against clock skew between the camera and
+                     the caller
+
+    """
+    def __init__(self, process_noise: float = 2000., measurement_noise: float = 4.,
+                 max_coast: float = .5, max_horizon: float = .5):
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.max_coast = max_coast
+        self.max_horizon = max_horizon
+        self._H = np.array([[1., 0, 0, 0], [0, 1., 0, 0]])
+        self.reset()
+
+    def reset(self):
+        self.state: Optional[np.ndarray] = None
+        self.covariance: Optional[np.ndarray] = None
+        self.timestamp: Optional[float] = None
+
+    @property
+    def velocity(self):
+        return None if self.state is None else self.state[2:]
+
+    def _transition(self, dt):
+        F = np.eye(4)
+        F[0, 2] = F[1, 3] = dt
+        q = self.process_noise
+        Q_axis = q * np.array([[dt ** 3 / 3, dt ** 2 / 2], [dt ** 2 / 2, dt]])
+        Q = np.zeros((4, 4))
+        Q[np.ix_([0, 2], [0, 2])] = Q_axis
+        Q[np.ix_([1, 3], [1, 3])] = Q_axis
+        return F, Q
+
+    def update(self, position: Sequence[float], timestamp: float):
+        """Add the measured :code:`position` of the object captured at :code:`timestamp`
+
+        Measurements older than the last one are ignored.
+
+        """
+        z = np.asarray(position, dtype=float)
+        if self.state is None or timestamp - self.timestamp > self.max_coast:
+            r = self.measurement_noise
+            self.state = np.array([z[0], z[1], 0., 0.])
+            self.covariance = np.diag([r, r, 1e4, 1e4])
+            self.timestamp = timestamp
+            return
+        dt = timestamp - self.timestamp
+        if dt < 0:
+            return
+        F, Q = self._transition(dt)
+        state = F @ self.state
+        P = F @ self.covariance @ F.T + Q
+        H = self._H
+        S = H @ P @ H.T + self.measurement_noise * np.eye(2)
+        K = P @ H.T @ np.linalg.inv(S)
+        self.state = state + K @ (z - H @ state)
+        self.covariance = (np.eye(4) - K @ H) @ P
+        self.timestamp = timestamp
+
+    def predict(self, timestamp: float) -> Optional[np.ndarray]:
+        """The position :code:`[x, y]` of the object at :code:`timestamp`
+
+        Returns :code:`None` if there's no track or the last measurement is
+        older than :code:`max_coast`.
+
+        """
+        if self.state is None or timestamp - self.timestamp > self.max_coast:
+            return None
+        dt = min(max(timestamp - self.timestamp, 0), self.max_horizon)
+        return self.state[:2] + dt * self.state[2:]
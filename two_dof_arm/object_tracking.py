@@ -1,8 +1,15 @@
+from typing import NamedTuple, Optional, Tuple
+import time
 import argparse
 
 import numpy as np
 import cv2 as cv
 
+import repo_dirs
+from pipeline import Pipeline
+from estimator import TargetEstimator
+from pid import PIDController
+
 
 def gstreamer_pipeline(width=512, height=512, flip_180=False):
     args = ["libcamerasrc", f"video/x-raw, width={width}, height={height}"]
@@ -63,7 +70,7 @@ def show_image(img, name=None, img_scale=1):
     cv.destroyWindow(name)
 
 
-def get_contours_and_mask_hsv(img, low_val, high_val):
+def get_mask_hsv(img, low_val, high_val):
     hsv_img = cv.cvtColor(img, cv.COLOR_BGR2HSV)
 
     # low_red = np.array([163, 74, 30])
@@ -72,72 +79,341 @@ def get_contours_and_mask_hsv(img, low_val, high_val):
     mask = cv.inRange(hsv_img, low_val, high_val)
     mask = cv.erode(mask, np.ones((5, 5), dtype='uint8'), iterations=1)
     # red = cv.bitwise_and(frame, frame, mask=red_mask)
+    return mask
+
+
+def get_mask_bgr(img, low_val, high_val):
+    return cv.inRange(img, low_val, high_val)
+
+
+class HSVMaskLUT:
+    """Threshold BGR images in HSV with a lookup table instead of :func:`cv.cvtColor`
+
+    The BGR values are quantized to :code:`bits` bits per channel and the mask
+    of each quantized colour is computed once when the thresholds change.
+    Each frame is then masked with a single table lookup.
+
+    A low hue greater than the high hue wraps around 180, so that red can be
+    given as a single range, e.g. :code:`[170, 120, 70]` to :code:`[10, 255, 255]`.
+
+    An instance is a drop in replacement for :func:`get_mask_hsv`.
+
+    Args:
+        bits: Bits per channel of the quantized colours
+        erode: Erode the mask as :func:`get_mask_hsv` does
+
+    """
+    def __init__(self, bits: int = 5, erode: bool = True):
+        self.bits = bits
+        self.erode = erode
+        self._thresholds = None
+        self._table = None
+        self._weights = np.array([[1 << (2 * bits), 1 << bits, 1]], dtype=np.float32)
+
+    def build(self, low_val, high_val):
+        """Compute the mask of each quantized colour. Called only when the thresholds change."""
+        levels = 1 << self.bits
+        step = 256 // levels
+        # Center of each quantization bin, in the order of the table index
+        values = (np.arange(levels) * step + step // 2).astype(np.uint8)
+        b, g, r = np.meshgrid(values, values, values, indexing="ij")
+        colours = np.stack([b, g, r], -1).reshape(1, -1, 3)
+        hsv = cv.cvtColor(colours, cv.COLOR_BGR2HSV)[0].astype(np.int32)
+        low_val, high_val = np.asarray(low_val), np.asarray(high_val)
+        in_sv = np.all((hsv[:, 1:] >= low_val[1:]) & (hsv[:, 1:] <= high_val[1:]), axis=1)
+        if low_val[0] <= high_val[0]:
+            in_h = (hsv[:, 0] >= low_val[0]) & (hsv[:, 0] <= high_val[0])
+        else:
+            in_h = (hsv[:, 0] >= low_val[0]) | (hsv[:, 0] <= high_val[0])
+        self._table = np.where(in_h & in_sv, 255, 0).astype(np.uint8)
+        self._thresholds = (tuple(low_val), tuple(high_val))
+
+    def __call__(self, img, low_val, high_val):
+        if self._thresholds != (tuple(low_val), tuple(high_val)):
+            self.build(low_val, high_val)
+        quantized = np.right_shift(img, 8 - self.bits).astype(np.uint16)
+        index = cv.transform(quantized, self._weights)
+        mask = np.take(self._table, index)
+        if self.erode:
+            mask = cv.erode(mask, np.ones((5, 5), dtype='uint8'), iterations=1)
+        return mask
+
 
+def get_contours_and_mask_hsv(img, low_val, high_val):
+    mask = get_mask_hsv(img, low_val, high_val)
     contours, _ = cv.findContours(mask, cv.RETR_LIST, cv.CHAIN_APPROX_NONE)
     return contours, mask
 
 
 def get_contours_and_mask_bgr(img, low_val, high_val):
-    mask = cv.inRange(img, low_val, high_val)
+    mask = get_mask_bgr(img, low_val, high_val)
     contours, _ = cv.findContours(mask, cv.RETR_LIST, cv.CHAIN_APPROX_NONE)
     return contours, mask
 
 
-def main(width, height, low_val, high_val):
+class Blob(NamedTuple):
+    """An object found by :class:`BlobDetector`
+
+    :code:`centroid` is (x, y), :code:`bbox` is (x, y, w, h) and :code:`area`
+    is in pixels, all in the coordinates of the mask.
+
+    """
+    centroid: Tuple[float, float]
+    area: int
+    bbox: Tuple[int, int, int, int]
+
+    @property
+    def midpoint(self):
+        """Integer centroid, for drawing and :func:`calc_pos`"""
+        return int(round(self.centroid[0])), int(round(self.centroid[1]))
+
+    def offset(self, x, y):
+        """The blob shifted by (x, y)"""
+        bx, by, w, h = self.bbox
+        return Blob((self.centroid[0] + x, self.centroid[1] + y), self.area,
+                    (bx + x, by + y, w, h))
+
+
+class BlobDetector:
+    """Find the largest blob of a mask.
+
+    Instead of finding all the contours at full resolution and sorting them
+    by area, the mask is downscaled by :code:`2 ** levels` (which also drops
+    the specks of noise) and the largest connected component is picked from
+    its statistics. Only the window of the winner is then labelled again at
+    full resolution for its exact centroid, area and bounding box.
+
+    If nothing survives the downscaling, the full resolution mask is searched
+    so that small objects are still found.
+
+    Args:
+        levels: Number of pyramid levels to go down
+        min_area: Minimum area in pixels at full resolution
+
+    """
+    def __init__(self, levels: int = 2, min_area: int = 0):
+        self.levels = levels
+        self.min_area = min_area
+
+    @staticmethod
+    def _largest(mask):
+        n, labels, stats, centroids = cv.connectedComponentsWithStats(mask, connectivity=8)
+        if n <= 1:
+            return None
+        label = 1 + int(np.argmax(stats[1:, cv.CC_STAT_AREA]))
+        x, y, w, h, area = (int(v) for v in stats[label])
+        return Blob((float(centroids[label][0]), float(centroids[label][1])), area, (x, y, w, h))
+
+    def detect(self, mask) -> Optional[Blob]:
+        """Return the largest :class:`Blob` of the binary :code:`mask` or :code:`None`"""
+        if not cv.countNonZero(mask):
+            return None
+        scale = 2 ** self.levels
+        height, width = mask.shape[:2]
+        if self.levels and height >= 2 * scale and width >= 2 * scale:
+            small = cv.resize(mask, (width // scale, height // scale),
+                              interpolation=cv.INTER_AREA)
+            candidate = self._largest(cv.threshold(small, 127, 255, cv.THRESH_BINARY)[1])
+        else:
+            candidate = None
+        if candidate is None:
+            blob = self._largest(mask)
+        else:
+            x, y, w, h = candidate.bbox
+            x0, y0 = max(0, (x - 1) * scale), max(0, (y - 1) * scale)
+            x1, y1 = min(width, (x + w + 1) * scale), min(height, (y + h + 1) * scale)
+            blob = self._largest(mask[y0:y1, x0:x1])
+            blob = blob and blob.offset(x0, y0)
+        if blob is None or blob.area < self.min_area:
+            return None
+        return blob
+
+
+def draw_blob(blob, img):
+    x, y, w, h = blob.bbox
+    cv.rectangle(img, (x, y), (x + w, y + h), (0, 255, 0), 2)
+
+
+class ROITracker:
+    """Track the largest object in a colour range within a window around its last position
+
+    Thresholding and blob detection run only on the last bounding box padded
+    on each side, as the object moves just a few pixels between frames. If
+    the object isn't found there, or it's cut off by the edge of the window,
+    the whole frame is searched again.
+
+    Args:
+        low_val: Low threshold per channel
+        high_val: High threshold per channel
+        hsv: Threshold in HSV (:func:`get_mask_hsv`) instead of
+             BGR (:func:`get_mask_bgr`)
+        lut: Threshold in HSV with a :class:`HSVMaskLUT`
+        padding: Padding around the last bounding box as a fraction of its size
+        min_padding: Minimum padding in pixels
+        detector: :class:`BlobDetector` to find the object in the mask
+
+    """
+    def __init__(self, low_val, high_val, hsv: bool = True, padding: float = .5,
+                 min_padding: int = 32, detector: Optional[BlobDetector] = None,
+                 lut: bool = False):
+        self.low_val = low_val
+        self.high_val = high_val
+        self.padding = padding
+        self.min_padding = min_padding
+        self.detector = detector or BlobDetector()
+        if lut:
+            self._threshold = HSVMaskLUT()
+        else:
+            self._threshold = get_mask_hsv if hsv else get_mask_bgr
+        self.bbox = None
+        self.roi = None
+        self._mask = None
+
+    def reset(self):
+        """Forget the last position so that the next frame is searched fully"""
+        self.bbox = None
+
+    def _window(self, shape):
+        x, y, w, h = self.bbox
+        pad_x = max(self.min_padding, int(w * self.padding))
+        pad_y = max(self.min_padding, int(h * self.padding))
+        return (max(0, x - pad_x), max(0, y - pad_y),
+                min(shape[1], x + w + pad_x), min(shape[0], y + h + pad_y))
+
+    def _search(self, img, window):
+        x0, y0, x1, y1 = window
+        mask = self._threshold(img[y0:y1, x0:x1], self.low_val, self.high_val)
+        self.roi = (x0, y0, x1 - x0, y1 - y0)
+        if self._mask is None or self._mask.shape != img.shape[:2]:
+            self._mask = np.zeros(img.shape[:2], dtype=np.uint8)
+        self._mask[:] = 0
+        self._mask[y0:y1, x0:x1] = mask
+        blob = self.detector.detect(mask)
+        return blob and blob.offset(x0, y0)
+
+    @staticmethod
+    def _clipped(blob, window, shape):
+        """Whether the :code:`blob` touches an edge of the window which isn't a frame edge"""
+        x, y, w, h = blob.bbox
+        x0, y0, x1, y1 = window
+        return ((x <= x0 and x0 > 0) or (y <= y0 and y0 > 0) or
+                (x + w >= x1 and x1 < shape[1]) or (y + h >= y1 and y1 < shape[0]))
+
+    def track(self, img):
+        """Find the object in the frame :code:`img`
+
+        Returns:
+            A tuple of the :class:`Blob` in frame coordinates (:code:`None`
+            if not found) and the threshold mask of the frame, which is zero
+            outside the searched window.
+
+        """
+        full = (0, 0, img.shape[1], img.shape[0])
+        blob = window = None
+        if self.bbox is not None:
+            window = self._window(img.shape)
+            blob = self._search(img, window)
+            if blob is not None and self._clipped(blob, window, img.shape):
+                blob = None
+        if blob is None and window != full:
+            blob = self._search(img, full)
+        self.bbox = None if blob is None else blob.bbox
+        return blob, self._mask
+
+
+def main(width, height, low_val, high_val, shm_name=None):
     # _gst_pipeline = gstreamer_pipeline(width, height, flip_180=True)
     # cap = cv.VideoCapture(_gst_pipeline, cv.CAP_GSTREAMER)
 
-    # NOTE: Capture directly from laptop camera
-    cap = cv.VideoCapture(0)
+    if shm_name:
+        # Read frames published by a FrameServer on the same board
+        repo_dirs.add("streaming")
+        from shm_ring import SharedFrameRing
+        cap = SharedFrameRing.attach(shm_name)
+    else:
+        # NOTE: Capture directly from laptop camera
+        cap = cv.VideoCapture(0)
 
     status, frame = cap.read()
     rows, cols, ch = frame.shape
-    x_mid = int(cols / 2)
-    y_mid = int(rows / 2)
 
     x_center = int(cols / 2)
     y_center = int(rows / 2)
 
-    x_pos = 90
-    y_pos = 90
+    pos = [90, 90]
 
     x_band = 50
     y_band = 50
 
-    while status:
-        frame = cv.flip(frame, 1)
-        contours, mask = get_contours_and_mask_bgr(frame, low_val, high_val)
-        # contours, mask = get_contours_and_mask_hsv(frame, low_val, high_val)
+    # Position changes in degrees per frame proportional to the offset in pixels
+    controllers = [PIDController(kp=.05, output_limits=(-10, 10),
+                                 integral_limits=(-3, 3), deadband=band)
+                   for band in (x_band, y_band)]
+
+    tracker = ROITracker(low_val, high_val, hsv=False)
+    estimator = TargetEstimator()
+    pipeline = Pipeline()
 
-        if not len(contours):
+    def capture():
+        status, frame = cap.read()
+        if not status:
+            pipeline.stop()
+            return None
+        # The default Picamera2 configuration of the FrameServer gives XBGR frames
+        if frame.ndim == 3 and frame.shape[2] == 4:
+            frame = cv.cvtColor(frame, cv.COLOR_BGRA2BGR)
+        return time.time(), cv.flip(frame, 1)
+
+    def detect(item):
+        timestamp, frame = item
+        blob, mask = tracker.track(frame)
+        if blob is None:
             print("No contour found")
-            status, frame = cap.read()
-            continue
-        areas = [cv.contourArea(x) for x in contours]
-        sorted_inds = np.argsort(areas)
-        max_area_contour = contours[sorted_inds[-1]]
+        # The mask buffer is reused by the tracker for the next frame
+        return timestamp, frame, blob, mask.copy()
+
+    def control(item):
+        timestamp, frame, blob, mask = item
+        if blob is not None:
+            estimator.update(blob.centroid, timestamp)
+        # Act on where the object is by now and keep going through short dropouts
+        now = time.time()
+        position = estimator.predict(now)
+        if position is None:
+            return item
+        for i, error in enumerate(position - (x_center, y_center)):
+            pos[i] = float(np.clip(pos[i] + controllers[i].update(error, now), 0, 180))
+        print(f"X, Y: ({pos[0]:.1f}, {pos[1]:.1f})")
+        return item
+
+    def display(item):
+        timestamp, frame, blob, mask = item
         # img = frame.copy()
 
-        draw_bounding_rect_for_contour(max_area_contour, frame)
+        if blob is not None:
+            draw_blob(blob, frame)
 
-        x_mid, y_mid = get_midpoints(max_area_contour)
+            x_mid, y_mid = blob.midpoint
 
-        # Draw horizontal centre line of red object
-        cv.line(frame, (x_mid, 0), (x_mid, height), (0, 255, 0), 2)
-        # Draw Vertical centre line of red object
-        cv.line(frame, (0, y_mid), (width, y_mid), (0, 255, 0), 2)
+            # Draw horizontal centre line of red object
+            cv.line(frame, (x_mid, 0), (x_mid, height), (0, 255, 0), 2)
+            # Draw Vertical centre line of red object
+            cv.line(frame, (0, y_mid), (width, y_mid), (0, 255, 0), 2)
         img = np.hstack([frame, np.repeat(mask, 3).reshape(*mask.shape, 3)])
         cv.imshow("IN Frame", img)
 
-        x_pos, y_pos = calc_pos(x_pos, y_pos, x_mid, y_mid,
-                                x_center, y_center, x_band, y_band)
-        print(f"X, Y: ({x_pos}, {y_pos})")
-
         key = cv.waitKey(1)
         if key == ord('q'):
-            break
-        status, frame = cap.read()
+            pipeline.stop()
 
+    pipeline.add_stage("capture", capture)
+    pipeline.add_stage("detect", detect)
+    pipeline.add_stage("control", control)
+    pipeline.add_stage("display", display)
+    pipeline.run()
+    # The capture stage may still be reading from cap
+    pipeline.join()
+    pipeline.print_stats()
 
     cv.destroyAllWindows()
     cap.release()
@@ -149,7 +425,8 @@ if __name__ == '__main__':
     parser.add_argument("-w", "--width", type=int, default=480)
     parser.add_argument("-lv", "--low-val")
     parser.add_argument("-hv", "--high-val")
+    parser.add_argument("--shm", help="Read frames from the shared memory ring of a FrameServer")
     args = parser.parse_args()
     low_val = np.array([*map(int, args.low_val.split(","))])
     high_val = np.array([*map(int, args.high_val.split(","))])
-    main(args.width, args.height, low_val, high_val)
+    main(args.width, args.height, low_val, high_val, args.shm)
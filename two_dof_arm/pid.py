@@ -0,0 +1,89 @@
+from typing import Optional, Tuple
+
+
+class PIDController:
+    """A PID controller for one axis of the arm
+
+    The output is the change of the servo position for an error of the object
+    from the center of the image, so the arm moves in proportion to how far
+    off it is instead of a fixed step. Use :code:`ki=kd=0` for a P controller
+    and :code:`kd=0` for a PI controller.
+
+    As the output is added to the position, the servo already integrates it
+    and a P controller has no steady state error for a still object. An
+    integral term makes the loop overshoot and wind up, so :code:`ki`
+    defaults to 0 and should only be set with :code:`integral_limits` for
+    an object moving at a steady speed.
+
+    Args:
+        kp: Proportional gain
+        ki: Integral gain, per second
+        kd: Derivative gain, in seconds
+        output_limits: Minimum and maximum output
+        integral_limits: Minimum and maximum of the integral term. The integral
+                         also isn't accumulated while the output is clamped
+                         (anti-windup).
+        max_rate: Maximum change of the output per second
+        deadband: Errors within :code:`deadband` of zero are taken as zero
+
+    """
+    def __init__(self, kp: float, ki: float = 0., kd: float = 0.,
+                 output_limits: Tuple[Optional[float], Optional[float]] = (None, None),
+                 integral_limits: Tuple[Optional[float], Optional[float]] = (None, None),
+                 max_rate: Optional[float] = None, deadband: float = 0.):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.output_limits = output_limits
+        self.integral_limits = integral_limits
+        self.max_rate = max_rate
+        self.deadband = deadband
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.
+        self.output = 0.
+        self._error: Optional[float] = None
+        self._timestamp: Optional[float] = None
+
+    @staticmethod
+    def _clamp(value, limits):
+        low, high = limits
+        if low is not None and value < low:
+            return low
+        if high is not None and value > high:
+            return high
+        return value
+
+    def update(self, error: float, timestamp: float) -> float:
+        """Return the output for the :code:`error` measured at :code:`timestamp`
+
+        A timestamp which isn't newer than the last one gives :code:`0.` and
+        leaves the state as it is, since the output is applied as a change
+        of position and repeating it would repeat the move.
+
+        """
+        if abs(error) <= self.deadband:
+            error = 0.
+        dt = None if self._timestamp is None else timestamp - self._timestamp
+        if dt is not None and dt <= 0:
+            return 0.
+        derivative = 0. if not dt or self._error is None else (error - self._error) / dt
+        integral = self.integral + error * (dt or 0.)
+        if self.ki:
+            integral = self._clamp(integral, (None if self.integral_limits[0] is None
+                                              else self.integral_limits[0] / self.ki,
+                                              None if self.integral_limits[1] is None
+                                              else self.integral_limits[1] / self.ki))
+        unclamped = self.kp * error + self.ki * integral + self.kd * derivative
+        output = self._clamp(unclamped, self.output_limits)
+        # Don't wind up the integral while the output is saturated
+        if output == unclamped or error * unclamped < 0:
+            self.integral = integral
+        if self.max_rate is not None and dt:
+            max_change = self.max_rate * dt
+            output = self._clamp(output, (self.output - max_change, self.output + max_change))
+        self.output = output
+        self._error = error
+        self._timestamp = timestamp
+        return output
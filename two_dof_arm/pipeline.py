@@ -0,0 +1,136 @@
+from typing import Callable, List, Optional
+from collections import deque
+from threading import Event, Thread
+import time
+
+import numpy as np
+
+import repo_dirs
+repo_dirs.add("streaming")
+
+from frame_cache import LatestFrame
+
+
+class StageStats:
+    """Service times of a pipeline stage
+
+    Args:
+        name: Name of the stage
+        window: Number of recent service times to keep for the percentiles
+
+    """
+    def __init__(self, name: str, window: int = 1000):
+        self.name = name
+        self.count = 0
+        self.dropped = 0
+        self.total = 0.
+        self._times: deque = deque(maxlen=window)
+        self._latencies: deque = deque(maxlen=window)
+
+    def add(self, service_time: float, latency: float):
+        self.count += 1
+        self.total += service_time
+        self._times.append(service_time)
+        self._latencies.append(latency)
+
+    def summary(self):
+        """Count, drops, and mean and percentile service times and latency in ms"""
+        result = {"count": self.count, "dropped": self.dropped}
+        if self._times:
+            times = np.array(self._times) * 1000
+            result.update(mean_ms=float(times.mean()),
+                          p50_ms=float(np.percentile(times, 50)),
+                          p95_ms=float(np.percentile(times, 95)),
+                          max_ms=float(times.max()),
+                          latency_p50_ms=float(np.percentile(self._latencies, 50)) * 1000)
+        return result
+
+
+class Pipeline:
+    """A pipeline of stages each running in its own thread
+
+    The first stage is the source, called with no arguments. Each of the other
+    stages is called with the output of the previous one. A stage returning
+    :code:`None` drops the item. Stages are connected by latest wins slots
+    (:class:`frame_cache.LatestFrame`), so a slow stage always gets the newest item and
+    skips the stale ones instead of the queue growing behind it.
+
+    The last stage runs in the thread calling :meth:`run`, so that it can use
+    :func:`cv.imshow`. Any stage can call :meth:`stop`.
+
+    Each stage records its service time, the latency of the item since the
+    source produced it and the number of items it skipped, so that the
+    bottleneck is visible with :meth:`stats`.
+
+    Example:
+        pipeline = Pipeline()
+        pipeline.add_stage("capture", read_frame)
+        pipeline.add_stage("detect", detect)
+        pipeline.add_stage("display", display)
+        pipeline.run()
+        pipeline.print_stats()
+
+    """
+    def __init__(self):
+        self._stages: List = []
+        self._running = Event()
+        self._threads: List[Thread] = []
+
+    def add_stage(self, name: str, func: Callable):
+        self._stages.append((StageStats(name), func, LatestFrame()))
+        return self
+
+    def _step(self, index, previous):
+        stats, func, output = self._stages[index]
+        if index == 0:
+            item, timestamp = (), time.time()
+        else:
+            count, timestamp, item = self._stages[index - 1][2].wait(previous, timeout=.1)
+            if item is None:
+                return previous
+            if previous is not None:
+                stats.dropped += count - previous - 1
+            previous = count
+        start = time.time()
+        result = func(*item)
+        end = time.time()
+        stats.add(end - start, end - timestamp)
+        if result is not None:
+            output.publish((result,), timestamp)
+        return previous
+
+    def _loop(self, index):
+        previous = None if index else 0
+        while self._running.is_set():
+            previous = self._step(index, previous)
+
+    def run(self):
+        """Run the stages until :meth:`stop` is called"""
+        if not self._stages:
+            raise ValueError("No stages in the pipeline")
+        self._running.set()
+        self._threads = [Thread(target=self._loop, args=(i,), daemon=True)
+                         for i in range(len(self._stages) - 1)]
+        for t in self._threads:
+            t.start()
+        try:
+            self._loop(len(self._stages) - 1)
+        finally:
+            self.stop()
+            self.join(1)
+
+    def stop(self):
+        self._running.clear()
+
+    def join(self, timeout: Optional[float] = None):
+        for t in self._threads:
+            t.join(timeout)
+
+    def stats(self):
+        """Summary of :class:`StageStats` of each stage"""
+        return {stats.name: stats.summary() for stats, _, _ in self._stages}
+
+    def print_stats(self):
+        for name, summary in self.stats().items():
+            print(name, ", ".join(f"{k}: {v:.2f}" if isinstance(v, float) else f"{k}: {v}"
+                                  for k, v in summary.items()))
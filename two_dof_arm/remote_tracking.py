@@ -1,14 +1,20 @@
-from typing import List, Union
+from typing import List, Optional, Tuple, Union
+import time
 import argparse
-import base64
 
-import requests
 import numpy as np
 import cv2 as cv
 
 from common_pyutil.monitor import Timer
-from object_tracking import (get_contours_and_mask_hsv, get_midpoints,
-                             draw_bounding_rect_for_contour)
+
+import repo_dirs
+repo_dirs.add("streaming")
+
+from frame_client import FrameClient
+from pipeline import Pipeline
+from estimator import TargetEstimator
+from pid import PIDController
+from object_tracking import ROITracker, get_contours_and_mask_hsv
 
 
 timer = Timer()
@@ -27,6 +33,12 @@ class RemoteClient:
         convert: Convert from BGR2RGB
         low_val: Low threshold per channel for image
         high_val: High threshold per channel for image
+        track_width: Width of the frames requested by :meth:`simple_agent`. The
+                     server resizes them once per frame for all the clients
+                     asking for the same width. :code:`None` for full size.
+        controllers: :class:`PIDController` for the horizontal and the vertical
+                     moves of :meth:`simple_agent`, from the offset of the
+                     object in pixels to the change of servo position
 
     The current version tracks a red object after converting the image to HSV
     which is fairly easy. A more advanced client should detect specific objects
@@ -37,7 +49,9 @@ class RemoteClient:
     def __init__(self, host: str, port: Union[int, str],
                  img_size: List[int] = [640, 480], flip: int = 0,
                  convert: bool = False, low_val: List[int] = [0, 0, 0],
-                 high_val: List[int] = [255, 255, 255]):
+                 high_val: List[int] = [255, 255, 255],
+                 track_width: Optional[int] = 320,
+                 controllers: Optional[Tuple[PIDController, PIDController]] = None):
         self._host = host
         self._port = port
         self._flip = flip
@@ -47,76 +61,143 @@ class RemoteClient:
         self._high_val = np.array(high_val)
         self._img_size = img_size
         self._center = np.array(self._img_size)/2
+        self._track_width = track_width
+        self._controllers = controllers or tuple(
+            PIDController(kp=.1, output_limits=(-200, 200), integral_limits=(-20, 20),
+                          max_rate=2000, deadband=5)
+            for _ in range(2))
+        self._client = FrameClient(self._host, self._port)
+
+    def get_frame(self, timeout=.05):
+        """Get the newest frame not seen before from the prefetching :class:`FrameClient`
+
+        Returns :code:`None` if there was no new frame within :code:`timeout`.
+
+        """
+        seq, timestamp, img = self._client.read(timeout)
+        return img
+
+    def _to_img_size(self, point, frame):
+        """Scale a point in :code:`frame`, requested at :code:`track_width`, to :code:`img_size`
+
+        The scale is from the width of the frame the object was found in, not
+        of the displayed image which has the mask stacked next to it.
+
+        """
+        return np.array(point) * (self._img_size[0] / frame.shape[1])
 
     def simple_agent(self):
         """A Simple Agent which navigates the robotic arm based on deltas from
         the center of the image.
 
+        The frames are requested at :code:`track_width` and the deltas are
+        scaled back to :code:`img_size`. The moves are based on the position
+        of the object predicted by a :class:`TargetEstimator` for the time of
+        the command from the capture timestamps. As those are from the clock
+        of the arm, the time of the command is the capture timestamp of the
+        frame plus the time elapsed on the client since the frame was read, so
+        the clocks don't need to be synchronized. Fetching, detection, the move requests
+        and display run as stages of a :class:`Pipeline`, and their timings are
+        printed at the end.
+
         """
-        server = self._server
-        while True:
+        self._client.params = {"width": self._track_width} if self._track_width else {}
+        tracker = ROITracker(self._low_val, self._high_val)
+        estimator = TargetEstimator()
+        x_controller, y_controller = self._controllers
+        x_controller.reset()
+        y_controller.reset()
+        pipeline = Pipeline()
+
+        def capture():
+            seq, timestamp, img = self._client.read(.05)
+            return None if img is None else (timestamp, time.time(), img)
+
+        def detect(item):
+            timestamp, received, img = item
+            blob, mask = tracker.track(img)
+            if blob is None:
+                print("No contour found")
+            # The mask buffer is reused by the tracker for the next frame
+            return timestamp, received, img, blob, mask.copy()
+
+        def control(item):
+            timestamp, received, img, blob, mask = item
+            if blob is not None:
+                estimator.update(self._to_img_size(blob.centroid, img), timestamp)
+            # Where the object is by now, rather than where it was at capture,
+            # on the clock of the arm
+            now = timestamp + time.time() - received
+            position = estimator.predict(now)
+            if position is not None:
+                x_d, y_d = position - self._center
+                x_delta = int(x_controller.update(x_d, now))
+                y_delta = int(y_controller.update(y_d, now))
+                print(*position, x_d, y_d, x_delta, y_delta)
+                if x_delta:
+                    resp = self._client.get("/horizontal", delta=x_delta)
+                if y_delta:
+                    resp = self._client.get("/vertical", delta=-y_delta)
+            return item
+
+        def display(item):
+            timestamp, received, img, blob, mask = item
+            img = np.hstack([img, np.repeat(mask, 3).reshape(*mask.shape, 3)])
+            if blob is not None:
+                cv.circle(img, blob.midpoint, 10, (0, 255, 0))
+            cv.imshow("img", img)
             key = cv.waitKey(1)
-            with timer:
-                resp = requests.get(f"{server}/get_frame")
-            img = cv.imdecode(np.frombuffer(base64.b64decode(resp.content), dtype=np.uint8),
-                              flags=cv.IMREAD_COLOR)
-            x_mid = y_mid = x_d = y_d = 0
-            try:
-                contours, mask = get_contours_and_mask_hsv(img, self._low_val, self._high_val)
-                img = np.hstack([img, np.repeat(mask, 3).reshape(*mask.shape, 3)])
-                if not len(contours):
-                    print("No contour found")
-                else:
-                    areas = [cv.contourArea(x) for x in contours]
-                    sorted_inds = np.argsort(areas)
-                    max_area_contour = contours[sorted_inds[-1]]
-                    x_mid, y_mid = get_midpoints(max_area_contour)
-                    cv.circle(img, (x_mid, y_mid), 10, (0, 255, 0))
-                    x_d, y_d = self._center/2
-                    print(x_mid, y_mid, x_d, y_d)
-                if np.abs(x_d) > 5:
-                    resp = requests.get(f"{server}/horizontal?delta={int(x_d/10)}")
-                if np.abs(y_d) > 5:
-                    resp = requests.get(f"{server}/vertical?delta={-int(y_d/10)}")
-                cv.imshow("img", img)
-            except KeyboardInterrupt:
-                cv.destroyAllWindows()
             if key == ord("q") or key == 27:
                 print("Aborted Rotation")
-                break
+                pipeline.stop()
+
+        pipeline.add_stage("capture", capture)
+        pipeline.add_stage("detect", detect)
+        pipeline.add_stage("control", control)
+        pipeline.add_stage("display", display)
+        self._client.start()
+        try:
+            pipeline.run()
+        except KeyboardInterrupt:
+            pass
+        pipeline.print_stats()
         cv.destroyAllWindows()
+        self._client.stop()
 
     def manual_remote_tracking(self):
         """Manually control the 2 DOF robotic arm with a keyboard
         """
-        server = self._server
+        self._client.params = {}
+        self._client.start()
         i = 0
         while True:
             key = cv.waitKey(1)
             with timer:
-                resp = requests.get(f"{server}/get_frame")
+                img = self.get_frame()
             print(timer.time)
-            img = cv.imdecode(np.frombuffer(base64.b64decode(resp.content), dtype=np.uint8),
-                              flags=cv.IMREAD_COLOR)
-            if self._convert:
-                img = img[:, :, ::-1]
             if key == 81:
-                resp = requests.get(f"{server}/go_left")
+                resp = self._client.get("/go_left")
                 print("Going left")
             if key == 82:
-                resp = requests.get(f"{server}/go_up")
+                resp = self._client.get("/go_up")
                 print("Going up")
             elif key == 83:
-                resp = requests.get(f"{server}/go_right")
+                resp = self._client.get("/go_right")
                 print("Going right")
             elif key == 84:
-                resp = requests.get(f"{server}/go_down")
+                resp = self._client.get("/go_down")
                 print("Going down")
             # elif key == ord("a"):
             #     print("Setting new Rotation")
             elif key == ord("q") or key == 27:
                 print("Aborted Rotation")
                 break
+            # After the keys, so that the arm can be moved and the viewer
+            # closed while no frames arrive
+            if img is None:
+                continue
+            if self._convert:
+                img = img[:, :, ::-1]
             try:
                 # contours, mask = get_contours_and_mask_bgr(img, self._low_val, self._high_val)
                 contours, mask = get_contours_and_mask_hsv(img, self._low_val, self._high_val)
@@ -127,6 +208,7 @@ class RemoteClient:
             except KeyboardInterrupt:
                 cv.destroyAllWindows()
         cv.destroyAllWindows()
+        self._client.stop()
 
 
 if __name__ == '__main__':
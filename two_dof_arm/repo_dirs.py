@@ -0,0 +1,20 @@
+from pathlib import Path
+import sys
+
+
+repo = Path(__file__).resolve().parent.parent
+
+
+def add(*names):
+    """Put the directories :code:`names` of the repo, next to this one, on :code:`sys.path`
+
+    The scripts here are run directly and import the modules of
+    :code:`streaming` and :code:`sc08a` by name, the same as the scripts
+    in those directories do. :code:`sc08a.py` loads this file with
+    :func:`runpy.run_path` for the same.
+
+    """
+    for name in names:
+        path = str(repo / name)
+        if path not in sys.path:
+            sys.path.insert(1, path)